@@ -0,0 +1,61 @@
+import argparse
+import time
+import torch
+from classification_ModelNet40.models import pointmlp
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('torch.compile benchmark')
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--model', default='pointMLPElite', type=str)
+    parser.add_argument('--batch_size', default=[1, 16], type=int, nargs='+')
+    parser.add_argument('--num_points', default=1024, type=int)
+    parser.add_argument('--mode', default=None, type=str, help='torch.compile mode, e.g. max-autotune')
+    parser.add_argument('--repeats', default=10, type=int)
+    return parser.parse_args()
+
+
+def timeit(net, data, repeats):
+    # returns the milliseconds per forward pass, the compilation happened in compile_model
+    with torch.no_grad():
+        net(data)
+        if data.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeats):
+            out = net(data)
+        if data.is_cuda:
+            torch.cuda.synchronize()
+    return (time.time() - start) / repeats * 1000, out
+
+
+def main():
+    args = parse_args()
+    torch.manual_seed(0)
+    net = pointmlp.__dict__[args.model]().to(args.device).eval()
+
+    print(f"device: {args.device}, model: {args.model}, points: {args.num_points}, threads: {torch.get_num_threads()}")
+    print(f"{'batch':>6}{'method':>22}{'latency':>12}{'speedup':>10}{'compile':>10}{'max |dlogit|':>14}")
+    for batch_size in args.batch_size:
+        data = torch.rand(batch_size, 3, args.num_points, device=args.device)
+        methods = [
+            ("eager", lambda: net),
+            ("eager, fused bn", lambda: net.fuse_for_inference(data)),
+            ("compiled", lambda: pointmlp.compile_model(net, data, mode=args.mode)),
+            ("compiled, fused grp", lambda: pointmlp.compile_model(net, data, mode=args.mode, fused_grouping=True)),
+        ]
+        reference = expected = None
+        for name, build in methods:
+            torch._dynamo.reset()  # every batch size and method compiles from scratch
+            start = time.time()
+            model = build()
+            compile_time = time.time() - start
+            latency, out = timeit(model, data, args.repeats)
+            if reference is None:
+                reference, expected = latency, out
+            print(f"{batch_size:>6}{name:>22}{latency:>10.1f}ms{reference / latency:>9.2f}x{compile_time:>9.1f}s"
+                  f"{(out - expected).abs().max().item():>14.5f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import time
+import torch
+from pointnet2_ops import pointnet2_utils
+from classification_ScanObjectNN.models.pointmlp import farthest_point_sample
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('FPS benchmark')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--npoint', default=512, type=int, help='number of sampled points')
+    parser.add_argument('--num_points', default=[1024, 2048, 8192, 65536], type=int, nargs='+')
+    parser.add_argument('--repeats', default=3, type=int)
+    return parser.parse_args()
+
+
+def loop_farthest_point_sample(xyz, npoint):
+    # the former python implementation of farthest_point_sample, kept as the reference
+    device = xyz.device
+    B, N, C = xyz.shape
+    centroids = torch.zeros(B, npoint, dtype=torch.long).to(device)
+    distance = torch.ones(B, N).to(device) * 1e10
+    farthest = torch.randint(0, N, (B,), dtype=torch.long).to(device)
+    batch_indices = torch.arange(B, dtype=torch.long).to(device)
+    for i in range(npoint):
+        centroids[:, i] = farthest
+        centroid = xyz[batch_indices, farthest, :].view(B, 1, 3)
+        dist = torch.sum((xyz - centroid) ** 2, -1)
+        distance = torch.min(distance, dist)
+        farthest = torch.max(distance, -1)[1]
+    return centroids
+
+
+def timeit(fn, xyz, npoint, repeats):
+    fn(xyz, npoint)  # warm up, scripting on old torch and kernel caches
+    if xyz.is_cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeats):
+        fn(xyz, npoint)
+    if xyz.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeats * 1000
+
+
+def main():
+    args = parse_args()
+    methods = [
+        ("loop", loop_farthest_point_sample),
+        ("in-place", farthest_point_sample),
+        ("grid", lambda xyz, npoint: farthest_point_sample(xyz, npoint, approximate=True)),
+        ("pointnet2_ops", pointnet2_utils.furthest_point_sample),
+    ]
+    print(f"device: {args.device}, batch size: {args.batch_size}, npoint: {args.npoint}")
+    print("N".rjust(8) + "".join(f"{name:>16}" for name, _ in methods) + f"{'speedup':>10}{'grid':>10}")
+    for N in args.num_points:
+        xyz = torch.rand(args.batch_size, N, 3, device=args.device)
+        times = [timeit(fn, xyz, args.npoint, args.repeats) for _, fn in methods]
+        print(f"{N:>8}" + "".join(f"{t:>14.1f}ms" for t in times) +
+              f"{times[0] / times[1]:>9.1f}x{times[0] / times[2]:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
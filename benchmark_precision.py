@@ -0,0 +1,71 @@
+import argparse
+import copy
+import time
+import torch
+from classification_ModelNet40.models import pointmlp
+from classification_ModelNet40.utils.misc import PRECISIONS, get_autocast, get_grad_scaler, cal_loss
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Mixed-precision benchmark')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--model', default='pointMLPElite', type=str)
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--num_points', default=1024, type=int)
+    parser.add_argument('--precision', default=list(PRECISIONS), type=str, nargs='+', choices=list(PRECISIONS))
+    parser.add_argument('--steps', default=5, type=int, help='timed training steps per precision')
+    return parser.parse_args()
+
+
+def train_steps(net, data, label, precision, steps):
+    # the same SGD steps as classification_ModelNet40/main.py, returns the losses and the seconds per step
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.01, momentum=0.9)
+    scaler = get_grad_scaler(data.device, precision)
+    losses = []
+    for step in range(steps + 1):
+        if step == 1:  # the first step warms up the kernels
+            if data.is_cuda:
+                torch.cuda.synchronize()
+            start = time.time()
+        optimizer.zero_grad()
+        with get_autocast(data.device, precision):
+            loss = cal_loss(net(data), label)
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)
+        torch.nn.utils.clip_grad_norm_(net.parameters(), 1)
+        scaler.step(optimizer)
+        scaler.update()
+        losses.append(loss.item())
+    return losses, (time.time() - start) / steps
+
+
+def main():
+    args = parse_args()
+    torch.manual_seed(0)
+    net = pointmlp.__dict__[args.model]().to(args.device)
+    data = torch.rand(args.batch_size, 3, args.num_points, device=args.device)
+    label = torch.randint(0, 40, (args.batch_size,), device=args.device)
+    test_data = torch.rand(args.batch_size, 3, args.num_points, device=args.device)
+
+    print(f"device: {args.device}, model: {args.model}, batch size: {args.batch_size}, points: {args.num_points}")
+    print(f"{'precision':>10}{'samples/s':>12}{'speedup':>10}{'last loss':>12}{'max |dlogit|':>14}{'top-1 agree':>13}")
+    reference = None
+    for precision in args.precision:
+        model = copy.deepcopy(net)
+        losses, step_time = train_steps(model, data, label, precision, args.steps)
+        # parity of the eval outputs of the same weights against fp32
+        model.eval()
+        with torch.no_grad():
+            with get_autocast(args.device, precision):
+                logits = model(test_data).float()
+            with get_autocast(args.device, 'fp32'):
+                expected = model(test_data)
+        if reference is None:
+            reference = step_time
+        print(f"{precision:>10}{args.batch_size / step_time:>12.1f}{reference / step_time:>9.2f}x{losses[-1]:>12.4f}"
+              f"{(logits - expected).abs().max().item():>14.4f}"
+              f"{(logits.argmax(1) == expected.argmax(1)).float().mean().item():>13.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 import os
 import glob
+import math
 import h5py
 import numpy as np
+import torch
 from torch.utils.data import Dataset
 os.environ["HDF5_USE_FILE_LOCKING"] = "FALSE"
 
@@ -35,6 +37,30 @@ def load_data(partition):
     all_label = np.concatenate(all_label, axis=0)
     return all_data, all_label
 
+
+def load_mmap_data(partition):
+    """
+    Flat memory-mapped copy of load_data(partition), converted once into modelnet40_mmap. The samples are served
+    as views of the mapping, so the DataLoader workers share one page-cache copy of the data.
+    Return:
+        points: [P, 3], label: [n, 1], offsets: [n + 1], cloud i is points[offsets[i]:offsets[i + 1]]
+    """
+    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+    MMAP_DIR = os.path.join(BASE_DIR, 'data', 'modelnet40_mmap')
+    names = ['points', 'label', 'offsets']
+    paths = [os.path.join(MMAP_DIR, '%s_%s.npy' % (partition, name)) for name in names]
+    if not all(os.path.exists(path) for path in paths):
+        data, label = load_data(partition)
+        offsets = np.arange(data.shape[0] + 1, dtype='int64') * data.shape[1]
+        os.makedirs(MMAP_DIR, exist_ok=True)
+        for path, array in zip(paths, [data.reshape(-1, data.shape[-1]), label, offsets]):
+            # written under a temporary name, concurrent runs never map a partial file
+            with open(path + '.%d.tmp' % os.getpid(), 'wb') as f:
+                np.save(f, array)
+            os.replace(path + '.%d.tmp' % os.getpid(), path)
+    # copy-on-write mapping: the pages stay shared until a sample is modified in place
+    return [np.load(path, mmap_mode='c') for path in paths]
+
 def random_point_dropout(pc, max_dropout_ratio=0.875):
     ''' batch_pc: BxNx3 '''
     # for b in range(batch_pc.shape[0]):
@@ -58,24 +84,106 @@ def jitter_pointcloud(pointcloud, sigma=0.01, clip=0.02):
     pointcloud += np.clip(sigma * np.random.randn(N, C), -1*clip, clip)
     return pointcloud
 
+def mix32(x):
+    # 32 bit integer hash of int64 tensors, the products stay below 2 ** 63
+    x = x & 0xffffffff
+    x = (((x >> 16) ^ x) * 0x45d9f3b) & 0xffffffff
+    x = (((x >> 16) ^ x) * 0x45d9f3b) & 0xffffffff
+    return (x >> 16) ^ x
+
+
+def hashed_uniform(keys, stream, n):
+    """
+    Input:
+        keys: per-sample random keys, [B] int64
+        stream: id of the random draw, so the different augmentations are independent
+        n: number of values per sample
+    Return:
+        uniform values in [0, 1) that only depend on (key, stream, position), [B, n]
+    """
+    x = mix32(mix32(keys * 0x9e37 + stream).view(-1, 1) + torch.arange(n, device=keys.device))
+    return (x >> 8).float() / 2 ** 24
+
+
+class BatchAugmentation(object):
+    def __init__(self, scale_low=2. / 3., scale_high=3. / 2., translate=0.2, shuffle=True,
+                 jitter_sigma=0., jitter_clip=0.02, max_dropout_ratio=0., seed=None):
+        """
+        Augments whole collated batches on their device: point dropout, anisotropic scaling, translation,
+        jitter and point shuffling. The random values of a sample are a hash of (seed, key), with the key
+        the number of samples augmented before it by default, so they do not depend on the device, the
+        number of workers or on the other samples of the batch.
+        :param translate: half width of the uniform translation
+        :param jitter_sigma: std of the gaussian jitter, 0 disables it
+        :param max_dropout_ratio: upper bound of the ratio of points replaced by the first one, 0 disables it
+        """
+        self.scale_low = scale_low
+        self.scale_high = scale_high
+        self.translate = translate
+        self.shuffle = shuffle
+        self.jitter_sigma = jitter_sigma
+        self.jitter_clip = jitter_clip
+        self.max_dropout_ratio = max_dropout_ratio
+        self.seed = int(torch.randint(0, 2 ** 31, [1])) if seed is None else seed
+        self.counter = 0
+
+    def __call__(self, pc, keys=None):
+        """
+        Input:
+            pc: point clouds, [B, N, 3]
+            keys: optional per-sample keys (e.g. dataset indices and epoch), [B]
+        Return:
+            augmented copy of pc, [B, N, 3]
+        """
+        B, N, C = pc.shape
+        if keys is None:
+            keys = torch.arange(self.counter, self.counter + B, device=pc.device)
+            self.counter += B
+        keys = mix32(keys.to(pc.device).long() + mix32(torch.tensor(self.seed, device=pc.device)))
+        if self.max_dropout_ratio > 0:
+            ratio = hashed_uniform(keys, 0, 1) * self.max_dropout_ratio
+            drop = hashed_uniform(keys, 1, N) <= ratio
+            pc = torch.where(drop.unsqueeze(-1), pc[:, :1], pc)
+        scale = self.scale_low + hashed_uniform(keys, 2, C) * (self.scale_high - self.scale_low)
+        shift = (hashed_uniform(keys, 3, C) * 2 - 1) * self.translate
+        pc = pc * scale.unsqueeze(1).to(pc.dtype) + shift.unsqueeze(1).to(pc.dtype)
+        if self.jitter_sigma > 0:
+            # Box-Muller transform of two uniform draws
+            u1, u2 = hashed_uniform(keys, 4, N * C), hashed_uniform(keys, 5, N * C)
+            noise = torch.sqrt(-2 * torch.log1p(-u1)) * torch.cos(2 * math.pi * u2)
+            noise = torch.clamp(self.jitter_sigma * noise, -self.jitter_clip, self.jitter_clip)
+            pc = pc + noise.view(B, N, C).to(pc.dtype)
+        if self.shuffle:
+            order = torch.argsort(hashed_uniform(keys, 6, N), dim=-1)
+            pc = torch.gather(pc, 1, order.unsqueeze(-1).expand(-1, -1, C))
+        return pc
+
 
 class ModelNet40(Dataset):
-    def __init__(self, num_points, partition='train'):
-        self.data, self.label = load_data(partition)
+    def __init__(self, num_points, partition='train', mmap=False, augment=True):
+        if mmap:
+            self.points, self.label, self.offsets = load_mmap_data(partition)
+        else:
+            self.data, self.label = load_data(partition)
+        self.mmap = mmap
+        self.augment = augment  # False when the batches go through BatchAugmentation instead
         self.num_points = num_points
         self.partition = partition        
 
     def __getitem__(self, item):
-        pointcloud = self.data[item][:self.num_points]
+        if self.mmap:
+            pointcloud = self.points[self.offsets[item]:self.offsets[item + 1]][:self.num_points]
+        else:
+            pointcloud = self.data[item][:self.num_points]
         label = self.label[item]
-        if self.partition == 'train':
+        if self.partition == 'train' and self.augment:
             # pointcloud = random_point_dropout(pointcloud) # open for dgcnn not for our idea  for all
             pointcloud = translate_pointcloud(pointcloud)
             np.random.shuffle(pointcloud)
         return pointcloud, label
 
     def __len__(self):
-        return self.data.shape[0]
+        return self.label.shape[0]
 
 
 if __name__ == '__main__':
@@ -13,11 +13,13 @@ import torch.optim
 import torch.utils.data
 import torch.utils.data.distributed
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 import models as models
-from utils import Logger, mkdir_p, progress_bar, save_model, save_args, cal_loss
-from data import ModelNet40
+from utils import Logger, mkdir_p, progress_bar, save_model, save_args, cal_loss, ClassificationMeter, \
+    PRECISIONS, get_autocast, get_grad_scaler, init_distributed, is_main_process, broadcast_object, shard_indices
+from data import ModelNet40, BatchAugmentation
 from torch.optim.lr_scheduler import CosineAnnealingLR
-import sklearn.metrics as metrics
 import numpy as np
 
 
@@ -35,18 +37,34 @@ def parse_args():
     parser.add_argument('--min_lr', default=0.005, type=float, help='min lr')
     parser.add_argument('--weight_decay', type=float, default=2e-4, help='decay rate')
     parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('--mmap', action='store_true', default=False, help='serve the data from a memory-mapped copy')
+    parser.add_argument('--batch_aug', action='store_true', default=False,
+                        help='augment the training batches on the device instead of in the workers')
+    parser.add_argument('--precision', default='fp32', choices=list(PRECISIONS),
+                        help='autocast precision of the forward pass, fp16 also scales the loss')
+    parser.add_argument('--checkpoint_stages', type=int, nargs='*', default=None,
+                        help='recompute the grouping of these encoder stages in backward to save memory, '
+                             'e.g. --checkpoint_stages 0 1; a bare --checkpoint_stages means all stages')
+    parser.add_argument('--ddp', action='store_true', default=False,
+                        help='DistributedDataParallel training, launch with torchrun --nproc_per_node=N main.py --ddp')
+    parser.add_argument('--sync_bn', action='store_true', default=False, help='SyncBatchNorm across the ranks with --ddp')
+    parser.add_argument('--print_freq', default=10, type=int, help='steps between two updates of the progress bar')
     parser.add_argument('--workers', default=8, type=int, help='workers')
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
+    rank, world_size, local_rank = init_distributed() if args.ddp else (0, 1, 0)
     if args.seed is None:
-        args.seed = np.random.randint(1, 10000)
+        args.seed = broadcast_object(np.random.randint(1, 10000))
     os.environ["HDF5_USE_FILE_LOCKING"] = "FALSE"
 
-    assert torch.cuda.is_available(), "Please ensure codes are executed in cuda."
-    device = 'cuda'
+    if args.ddp:
+        device = 'cuda:%d' % local_rank if torch.cuda.is_available() else 'cpu'
+    else:
+        assert torch.cuda.is_available(), "Please ensure codes are executed in cuda."
+        device = 'cuda'
     if args.seed is not None:
         torch.manual_seed(args.seed)
         np.random.seed(args.seed)
@@ -56,35 +74,46 @@ def main():
         torch.backends.cudnn.benchmark = False
         torch.backends.cudnn.deterministic = True
         os.environ['PYTHONHASHSEED'] = str(args.seed)
-    time_str = str(datetime.datetime.now().strftime('-%Y%m%d%H%M%S'))
+    time_str = broadcast_object(str(datetime.datetime.now().strftime('-%Y%m%d%H%M%S')))
     if args.msg is None:
         message = time_str
     else:
         message = "-" + args.msg
     args.checkpoint = 'checkpoints/' + args.model + message + '-' + str(args.seed)
-    if not os.path.isdir(args.checkpoint):
+    if not os.path.isdir(args.checkpoint) and is_main_process():
         mkdir_p(args.checkpoint)
 
     screen_logger = logging.getLogger("Model")
     screen_logger.setLevel(logging.INFO)
     formatter = logging.Formatter('%(message)s')
-    file_handler = logging.FileHandler(os.path.join(args.checkpoint, "out.txt"))
-    file_handler.setLevel(logging.INFO)
-    file_handler.setFormatter(formatter)
-    screen_logger.addHandler(file_handler)
+    if is_main_process():
+        file_handler = logging.FileHandler(os.path.join(args.checkpoint, "out.txt"))
+        file_handler.setLevel(logging.INFO)
+        file_handler.setFormatter(formatter)
+        screen_logger.addHandler(file_handler)
 
     def printf(str):
-        screen_logger.info(str)
-        print(str)
+        # only rank 0 logs
+        if is_main_process():
+            screen_logger.info(str)
+            print(str)
 
     # Model
     printf(f"args: {args}")
     printf('==> Building model..')
-    net = models.__dict__[args.model]()
+    # the test clouds are the same every epoch, validate() reuses their fps/knn indices
+    net = models.__dict__[args.model](grouping_cache_bytes=2 ** 28,
+                                      checkpoint_stages=True if args.checkpoint_stages == [] else args.checkpoint_stages)
     criterion = cal_loss
     net = net.to(device)
     # criterion = criterion.to(device)
-    if device == 'cuda':
+    if args.ddp:
+        if args.sync_bn:
+            net = torch.nn.SyncBatchNorm.convert_sync_batchnorm(net)
+        # one process per device, the gradients are averaged by all-reduce during backward
+        net = DistributedDataParallel(net, device_ids=[local_rank] if torch.cuda.is_available() else None)
+        cudnn.benchmark = True
+    elif device == 'cuda':
         net = torch.nn.DataParallel(net)
         cudnn.benchmark = True
 
@@ -96,17 +125,20 @@ def main():
     best_train_loss = float("inf")
     start_epoch = 0  # start from epoch 0 or last checkpoint epoch
     optimizer_dict = None
+    scaler_dict = None
+    logger = None
 
     if not os.path.isfile(os.path.join(args.checkpoint, "last_checkpoint.pth")):
-        save_args(args)
-        logger = Logger(os.path.join(args.checkpoint, 'log.txt'), title="ModelNet" + args.model)
-        logger.set_names(["Epoch-Num", 'Learning-Rate',
-                          'Train-Loss', 'Train-acc-B', 'Train-acc',
-                          'Valid-Loss', 'Valid-acc-B', 'Valid-acc'])
+        if is_main_process():
+            save_args(args)
+            logger = Logger(os.path.join(args.checkpoint, 'log.txt'), title="ModelNet" + args.model)
+            logger.set_names(["Epoch-Num", 'Learning-Rate',
+                              'Train-Loss', 'Train-acc-B', 'Train-acc',
+                              'Valid-Loss', 'Valid-acc-B', 'Valid-acc'])
     else:
         printf(f"Resuming last checkpoint from {args.checkpoint}")
         checkpoint_path = os.path.join(args.checkpoint, "last_checkpoint.pth")
-        checkpoint = torch.load(checkpoint_path)
+        checkpoint = torch.load(checkpoint_path, map_location=torch.device('cpu'))
         net.load_state_dict(checkpoint['net'])
         start_epoch = checkpoint['epoch']
         best_test_acc = checkpoint['best_test_acc']
@@ -115,24 +147,47 @@ def main():
         best_train_acc_avg = checkpoint['best_train_acc_avg']
         best_test_loss = checkpoint['best_test_loss']
         best_train_loss = checkpoint['best_train_loss']
-        logger = Logger(os.path.join(args.checkpoint, 'log.txt'), title="ModelNet" + args.model, resume=True)
+        if is_main_process():
+            logger = Logger(os.path.join(args.checkpoint, 'log.txt'), title="ModelNet" + args.model, resume=True)
         optimizer_dict = checkpoint['optimizer']
+        scaler_dict = checkpoint.get('scaler')
 
     printf('==> Preparing data..')
-    train_loader = DataLoader(ModelNet40(partition='train', num_points=args.num_points), num_workers=args.workers,
-                              batch_size=args.batch_size, shuffle=True, drop_last=True)
-    test_loader = DataLoader(ModelNet40(partition='test', num_points=args.num_points), num_workers=args.workers,
+    train_set = ModelNet40(partition='train', num_points=args.num_points, mmap=args.mmap, augment=not args.batch_aug)
+    test_set = ModelNet40(partition='test', num_points=args.num_points, mmap=args.mmap)
+    train_sampler = None
+    if args.ddp:
+        # --batch_size stays the global batch, split over the ranks
+        args.batch_size = args.batch_size // world_size
+        train_sampler = DistributedSampler(train_set, shuffle=True, drop_last=True)
+    train_loader = DataLoader(train_set, num_workers=args.workers, sampler=train_sampler,
+                              batch_size=args.batch_size, shuffle=train_sampler is None, drop_last=True)
+    # seeded per rank, so the ranks do not repeat the augmentation of each other
+    seed = args.seed + rank if args.seed is not None else None
+    augmentation = BatchAugmentation(seed=seed) if args.batch_aug else None
+    if augmentation is not None:
+        augmentation.counter = start_epoch * len(train_loader) * args.batch_size  # resumed runs draw new values
+    test_loader = DataLoader(test_set, num_workers=args.workers,
+                             sampler=shard_indices(len(test_set)) if args.ddp else None,
                              batch_size=args.batch_size // 2, shuffle=False, drop_last=False)
 
     optimizer = torch.optim.SGD(net.parameters(), lr=args.learning_rate, momentum=0.9, weight_decay=args.weight_decay)
     if optimizer_dict is not None:
         optimizer.load_state_dict(optimizer_dict)
+    scaler = get_grad_scaler(device, args.precision)
+    if scaler_dict and scaler.is_enabled():  # empty when saved by an fp32/bf16 run
+        scaler.load_state_dict(scaler_dict)
     scheduler = CosineAnnealingLR(optimizer, args.epoch, eta_min=args.min_lr, last_epoch=start_epoch - 1)
 
     for epoch in range(start_epoch, args.epoch):
         printf('Epoch(%d/%s) Learning Rate %s:' % (epoch + 1, args.epoch, optimizer.param_groups[0]['lr']))
-        train_out = train(net, train_loader, optimizer, criterion, device)  # {"loss", "acc", "acc_avg", "time"}
-        test_out = validate(net, test_loader, criterion, device)
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        train_out = train(net, train_loader, optimizer, criterion, device, augmentation, args.print_freq,
+                          args.precision, scaler)  # {"loss", "acc", "acc_avg", "time"}
+        # the shards of the test set differ in size, the forward passes must not wait for each other
+        test_out = validate(net.module if args.ddp else net, test_loader, criterion, device, args.print_freq,
+                            args.precision)
         scheduler.step()
 
         if test_out["acc"] > best_test_acc:
@@ -148,6 +203,8 @@ def main():
         best_test_loss = test_out["loss"] if (test_out["loss"] < best_test_loss) else best_test_loss
         best_train_loss = train_out["loss"] if (train_out["loss"] < best_train_loss) else best_train_loss
 
+        if not is_main_process():
+            continue
         save_model(
             net, epoch, path=args.checkpoint, acc=test_out["acc"], is_best=is_best,
             best_test_acc=best_test_acc,  # best test accuracy
@@ -156,7 +213,8 @@ def main():
             best_train_acc_avg=best_train_acc_avg,
             best_test_loss=best_test_loss,
             best_train_loss=best_train_loss,
-            optimizer=optimizer.state_dict()
+            optimizer=optimizer.state_dict(),
+            scaler=scaler.state_dict()
         )
         logger.append([epoch, optimizer.param_groups[0]['lr'],
                        train_out["loss"], train_out["acc_avg"], train_out["acc"],
@@ -166,7 +224,8 @@ def main():
         printf(
             f"Testing loss:{test_out['loss']} acc_avg:{test_out['acc_avg']}% "
             f"acc:{test_out['acc']}% time:{test_out['time']}s [best test acc: {best_test_acc}%] \n\n")
-    logger.close()
+    if logger is not None:
+        logger.close()
 
     printf(f"++++++++" * 2 + "Final results" + "++++++++" * 2)
     printf(f"++  Last Train time: {train_out['time']} | Last Test time: {test_out['time']}  ++")
@@ -176,76 +235,65 @@ def main():
     printf(f"++++++++" * 5)
 
 
-def train(net, trainloader, optimizer, criterion, device):
+def train(net, trainloader, optimizer, criterion, device, augmentation=None, print_freq=10, precision='fp32',
+          scaler=None):
     net.train()
-    train_loss = 0
-    correct = 0
-    total = 0
-    train_pred = []
-    train_true = []
+    meter = ClassificationMeter()
+    scaler = get_grad_scaler(device, precision) if scaler is None else scaler
     time_cost = datetime.datetime.now()
     for batch_idx, (data, label) in enumerate(trainloader):
         data, label = data.to(device), label.to(device).squeeze()
+        if augmentation is not None:
+            data = augmentation(data)
         data = data.permute(0, 2, 1)  # so, the input data shape is [batch, 3, 1024]
         optimizer.zero_grad()
-        logits = net(data)
-        loss = criterion(logits, label)
-        loss.backward()
+        with get_autocast(device, precision):
+            logits = net(data)
+            loss = criterion(logits, label)
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)  # clip the true gradients
         torch.nn.utils.clip_grad_norm_(net.parameters(), 1)
-        optimizer.step()
-        train_loss += loss.item()
-        preds = logits.max(dim=1)[1]
-
-        train_true.append(label.cpu().numpy())
-        train_pred.append(preds.detach().cpu().numpy())
-
-        total += label.size(0)
-        correct += preds.eq(label).sum().item()
-
-        progress_bar(batch_idx, len(trainloader), 'Loss: %.3f | Acc: %.3f%% (%d/%d)'
-                     % (train_loss / (batch_idx + 1), 100. * correct / total, correct, total))
+        scaler.step(optimizer)
+        scaler.update()
+        meter.update(loss, logits, label)
+        if batch_idx % print_freq == 0 or batch_idx == len(trainloader) - 1:
+            message = meter.progress()  # the only synchronization with the device besides the summary
+        if is_main_process():
+            progress_bar(batch_idx, len(trainloader), message)
 
     time_cost = int((datetime.datetime.now() - time_cost).total_seconds())
-    train_true = np.concatenate(train_true)
-    train_pred = np.concatenate(train_pred)
+    train_out = meter.summary()
     return {
-        "loss": float("%.3f" % (train_loss / (batch_idx + 1))),
-        "acc": float("%.3f" % (100. * metrics.accuracy_score(train_true, train_pred))),
-        "acc_avg": float("%.3f" % (100. * metrics.balanced_accuracy_score(train_true, train_pred))),
+        "loss": float("%.3f" % train_out["loss"]),
+        "acc": float("%.3f" % (100. * train_out["acc"])),
+        "acc_avg": float("%.3f" % (100. * train_out["acc_avg"])),
         "time": time_cost
     }
 
 
-def validate(net, testloader, criterion, device):
+def validate(net, testloader, criterion, device, print_freq=10, precision='fp32'):
     net.eval()
-    test_loss = 0
-    correct = 0
-    total = 0
-    test_true = []
-    test_pred = []
+    meter = ClassificationMeter()
     time_cost = datetime.datetime.now()
     with torch.no_grad():
         for batch_idx, (data, label) in enumerate(testloader):
             data, label = data.to(device), label.to(device).squeeze()
             data = data.permute(0, 2, 1)
-            logits = net(data)
-            loss = criterion(logits, label)
-            test_loss += loss.item()
-            preds = logits.max(dim=1)[1]
-            test_true.append(label.cpu().numpy())
-            test_pred.append(preds.detach().cpu().numpy())
-            total += label.size(0)
-            correct += preds.eq(label).sum().item()
-            progress_bar(batch_idx, len(testloader), 'Loss: %.3f | Acc: %.3f%% (%d/%d)'
-                         % (test_loss / (batch_idx + 1), 100. * correct / total, correct, total))
+            with get_autocast(device, precision):
+                logits = net(data)
+                loss = criterion(logits, label)
+            meter.update(loss, logits, label)
+            if batch_idx % print_freq == 0 or batch_idx == len(testloader) - 1:
+                message = meter.progress()
+            if is_main_process():
+                progress_bar(batch_idx, len(testloader), message)
 
     time_cost = int((datetime.datetime.now() - time_cost).total_seconds())
-    test_true = np.concatenate(test_true)
-    test_pred = np.concatenate(test_pred)
+    test_out = meter.summary()
     return {
-        "loss": float("%.3f" % (test_loss / (batch_idx + 1))),
-        "acc": float("%.3f" % (100. * metrics.accuracy_score(test_true, test_pred))),
-        "acc_avg": float("%.3f" % (100. * metrics.balanced_accuracy_score(test_true, test_pred))),
+        "loss": float("%.3f" % test_out["loss"]),
+        "acc": float("%.3f" % (100. * test_out["acc"])),
+        "acc_avg": float("%.3f" % (100. * test_out["acc_avg"])),
         "time": time_cost
     }
 
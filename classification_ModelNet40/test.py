@@ -12,9 +12,8 @@ import torch.utils.data
 import torch.utils.data.distributed
 from torch.utils.data import DataLoader
 import models as models
-from utils import progress_bar, IOStream
+from utils import progress_bar, IOStream, ClassificationMeter
 from data import ModelNet40
-import sklearn.metrics as metrics
 from helper import cal_loss
 import numpy as np
 import torch.nn.functional as F
@@ -71,13 +70,9 @@ def main():
     print(f"Vanilla out: {test_out}")
 
 
-def validate(net, testloader, criterion, device):
+def validate(net, testloader, criterion, device, print_freq=10):
     net.eval()
-    test_loss = 0
-    correct = 0
-    total = 0
-    test_true = []
-    test_pred = []
+    meter = ClassificationMeter()
     time_cost = datetime.datetime.now()
     with torch.no_grad():
         for batch_idx, (data, label) in enumerate(testloader):
@@ -85,22 +80,17 @@ def validate(net, testloader, criterion, device):
             data = data.permute(0, 2, 1)
             logits = net(data)
             loss = criterion(logits, label)
-            test_loss += loss.item()
-            preds = logits.max(dim=1)[1]
-            test_true.append(label.cpu().numpy())
-            test_pred.append(preds.detach().cpu().numpy())
-            total += label.size(0)
-            correct += preds.eq(label).sum().item()
-            progress_bar(batch_idx, len(testloader), 'Loss: %.3f | Acc: %.3f%% (%d/%d)'
-                         % (test_loss / (batch_idx + 1), 100. * correct / total, correct, total))
+            meter.update(loss, logits, label)
+            if batch_idx % print_freq == 0 or batch_idx == len(testloader) - 1:
+                message = meter.progress()
+            progress_bar(batch_idx, len(testloader), message)
 
     time_cost = int((datetime.datetime.now() - time_cost).total_seconds())
-    test_true = np.concatenate(test_true)
-    test_pred = np.concatenate(test_pred)
+    test_out = meter.summary()
     return {
-        "loss": float("%.3f" % (test_loss / (batch_idx + 1))),
-        "acc": float("%.3f" % (100. * metrics.accuracy_score(test_true, test_pred))),
-        "acc_avg": float("%.3f" % (100. * metrics.balanced_accuracy_score(test_true, test_pred))),
+        "loss": float("%.3f" % test_out["loss"]),
+        "acc": float("%.3f" % (100. * test_out["acc"])),
+        "acc_avg": float("%.3f" % (100. * test_out["acc_avg"])),
         "time": time_cost
     }
 
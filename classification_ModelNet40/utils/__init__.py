@@ -2,4 +2,5 @@
 """
 from .misc import *
 from .logger import *
+from .metrics import *
 from .progress.progress.bar import Bar as Bar
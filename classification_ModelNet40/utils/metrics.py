@@ -0,0 +1,63 @@
+'''Streaming metrics of the classification loops:
+    - ClassificationMeter: loss and confusion matrix accumulated on the device, read once per epoch.
+'''
+import numpy as np
+import torch
+import torch.distributed as dist
+
+__all__ = ['ClassificationMeter']
+
+
+class ClassificationMeter(object):
+    """Accumulates the loss and the confusion matrix of an epoch on the device of the logits,
+       nothing is copied to the host before progress() or summary().
+       acc and acc_avg match sklearn accuracy_score and balanced_accuracy_score.
+       Under torch.distributed the summary covers the samples of all ranks.
+    """
+    def __init__(self, num_classes=None):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        self.loss = None
+        self.confusion = None  # [true, pred] counts, flattened
+        self.steps = 0
+
+    def update(self, loss, logits, label):
+        """Returns the predictions of the batch."""
+        preds = logits.detach().max(dim=1)[1]
+        num_classes = self.num_classes or logits.size(1)
+        if self.confusion is None:
+            self.num_classes = num_classes
+            self.confusion = torch.zeros(num_classes ** 2, dtype=torch.long, device=logits.device)
+            self.loss = torch.zeros((), dtype=torch.float64, device=logits.device)
+        self.confusion += torch.bincount(label.view(-1) * num_classes + preds.view(-1), minlength=num_classes ** 2)
+        self.loss += loss.detach().double()
+        self.steps += 1
+        return preds
+
+    def progress(self):
+        """Message of the progress bar, synchronizes with the device."""
+        loss, correct, total = self.loss.item(), self.confusion[::self.num_classes + 1].sum().item(), self.confusion.sum().item()
+        return 'Loss: %.3f | Acc: %.3f%% (%d/%d)' % (loss / self.steps, 100. * correct / total, correct, total)
+
+    def all_reduce(self):
+        """Sums the counts of all ranks, every rank has to call it."""
+        steps = torch.tensor([self.steps], dtype=torch.float64, device=self.loss.device)
+        for tensor in [self.confusion, self.loss, steps]:
+            dist.all_reduce(tensor)
+        self.steps = int(steps.item())
+
+    def summary(self):
+        if dist.is_available() and dist.is_initialized():
+            self.all_reduce()
+        confusion = self.confusion.view(self.num_classes, self.num_classes).cpu().numpy()
+        seen = confusion.sum(axis=1)
+        correct = np.diag(confusion)
+        return {
+            "loss": self.loss.item() / self.steps,
+            "acc": correct.sum() / confusion.sum(),
+            # recall averaged over the classes present in the labels, like sklearn
+            "acc_avg": np.mean(correct[seen > 0] / seen[seen > 0]),
+            "confusion": confusion
+        }
@@ -9,6 +9,7 @@ import sys
 import time
 import math
 import torch
+import torch.distributed as dist
 import shutil
 import numpy as np
 import random
@@ -20,7 +21,9 @@ import torch.nn.init as init
 from torch.autograd import Variable
 
 __all__ = ['get_mean_and_std', 'init_params', 'mkdir_p', 'AverageMeter',
-           'progress_bar','save_model',"save_args","set_seed", "IOStream", "cal_loss"]
+           'progress_bar','save_model',"save_args","set_seed", "IOStream", "cal_loss",
+           "PRECISIONS", "get_autocast", "get_grad_scaler", "init_distributed", "is_main_process",
+           "broadcast_object", "shard_indices"]
 
 
 def get_mean_and_std(dataset):
@@ -233,3 +236,76 @@ def cal_loss(pred, gold, smoothing=True):
         loss = F.cross_entropy(pred, gold, reduction='mean')
 
     return loss
+
+
+PRECISIONS = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def get_autocast(device, precision='fp32'):
+    ''' Autocast context of --precision, a no-op for fp32. '''
+    dtype = PRECISIONS[precision]
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype, enabled=dtype is not None)
+
+
+class PassThroughScaler(object):
+    ''' The GradScaler interface without loss scaling, for fp32 and bf16 on any torch version. '''
+    def scale(self, loss):
+        return loss
+
+    def unscale_(self, optimizer):
+        pass
+
+    def step(self, optimizer, *args, **kwargs):
+        return optimizer.step(*args, **kwargs)
+
+    def update(self, new_scale=None):
+        pass
+
+    def is_enabled(self):
+        return False
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state_dict):
+        pass
+
+
+def get_grad_scaler(device, precision='fp32'):
+    ''' Loss scaling is only needed for fp16, for fp32 and bf16 the scaler is a pass-through. '''
+    if precision != 'fp16':
+        return PassThroughScaler()
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):  # torch>=2.3, any device
+        return torch.amp.GradScaler(torch.device(device).type)
+    assert torch.device(device).type == 'cuda', "fp16 training needs CUDA on this torch version, please use bf16."
+    return torch.cuda.amp.GradScaler()
+
+
+def init_distributed():
+    ''' Joins the process group started by torchrun, nccl with CUDA and gloo otherwise.
+        Returns the rank, the world size and the local rank. '''
+    dist.init_process_group('nccl' if torch.cuda.is_available() else 'gloo')
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+    return dist.get_rank(), dist.get_world_size(), local_rank
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def broadcast_object(obj):
+    ''' The value of rank 0 on every rank, e.g. for random seeds and time stamps. '''
+    if not dist.is_initialized():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def shard_indices(length):
+    ''' Evaluation samples of this rank, strided and without the padding of DistributedSampler. '''
+    if not dist.is_initialized():
+        return list(range(length))
+    return list(range(dist.get_rank(), length, dist.get_world_size()))
@@ -1,4 +1,5 @@
 import argparse
+import copy
 import os
 import datetime
 import torch
@@ -35,6 +36,10 @@ def parse_args():
     # Voting evaluation, referring: https://github.com/CVMI-Lab/PAConv/blob/main/obj_cls/eval_voting.py
     parser.add_argument('--NUM_PEPEAT', type=int, default=300)
     parser.add_argument('--NUM_VOTE', type=int, default=10)
+    parser.add_argument('--vote_workers', type=int, default=1,
+                        help='processes running the repeats, spread over the GPUs or the CPU cores')
+    parser.add_argument('--vote_chunk', type=int, default=None,
+                        help='clouds per forward pass of the votes [default: fit the free CUDA memory, batch size on CPU]')
 
     parser.add_argument('--validate', action='store_true', help='Validate the original testing result.')
     return parser.parse_args()
@@ -47,12 +52,119 @@ class PointcloudScale(object):  # input random scaling
 
     def __call__(self, pc):
         bsize = pc.size()[0]
-        for i in range(bsize):
-            xyz1 = np.random.uniform(low=self.scale_low, high=self.scale_high, size=[3])
-            pc[i, :, 0:3] = torch.mul(pc[i, :, 0:3], torch.from_numpy(xyz1).float().cuda())
+        # one draw for the whole batch, same random sequence as scaling the samples one by one
+        xyz1 = np.random.uniform(low=self.scale_low, high=self.scale_high, size=[bsize, 1, 3])
+        pc[:, :, 0:3] = torch.mul(pc[:, :, 0:3], torch.from_numpy(xyz1).float().to(pc.device))
 
         return pc
 
+    def sample(self, bsize, votes, rng=np.random):
+        """
+        Scales of all votes of a batch in one draw, same random sequence as votes - 1 calls. Vote 0 is the
+        unscaled cloud and each later vote rescales the previous one, like calling this object in place.
+        Return:
+            scales: [votes, bsize, 1, 3]
+        """
+        xyz = rng.uniform(low=self.scale_low, high=self.scale_high, size=[votes - 1, bsize, 1, 3])
+        return np.cumprod(np.concatenate([np.ones([1, bsize, 1, 3]), xyz]), axis=0)
+
+
+def vote_chunk_size(net, data, fraction=0.5):
+    """
+    Clouds per forward pass of the votes. On CUDA as many as fit into a fraction of the free memory,
+    measured with one forward pass of data, elsewhere the batch size.
+    """
+    if not data.is_cuda:
+        return data.size(0)
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    start = torch.cuda.memory_allocated()
+    with torch.no_grad():
+        net(data.permute(0, 2, 1))
+    per_cloud = max(torch.cuda.max_memory_allocated() - start, 1) / data.size(0)
+    free, _ = torch.cuda.mem_get_info()
+    return max(1, int(fraction * free / per_cloud))
+
+
+def vote_scores(net, data, scales, chunk_size, base=None):
+    """
+    Input:
+        data: test clouds, [B, N, C]
+        scales: scales of the xyz channels of each vote, [V, B, 1, 3]
+        chunk_size: clouds per forward pass
+        base: optional softmax scores of the unscaled vote 0, which is then not recomputed, [B, num_classes]
+    Return:
+        scores: softmax scores averaged over the votes, [B, num_classes]
+    """
+    V, B = scales.shape[:2]
+    scores = 0
+    if base is not None:
+        scores, scales = base, scales[1:]
+    if scales.shape[0] > 0:
+        clouds = data.unsqueeze(0).repeat(scales.shape[0], 1, 1, 1)
+        clouds[..., 0:3] *= scales
+        clouds = clouds.view(-1, *data.shape[1:]).permute(0, 2, 1)
+        votes = torch.cat([F.softmax(net(chunk), dim=1) for chunk in clouds.split(chunk_size)])
+        scores = scores + votes.view(scales.shape[0], B, -1).sum(dim=0)
+    return scores / V
+
+
+def voting_batches(net, testloader, device, chunk_size):
+    """
+    The test set on the device, with the scores of the unscaled vote 0 that every repeat shares.
+    Return:
+        batches: list of (data [B, N, C], label [B], base scores [B, num_classes])
+    """
+    batches = []
+    with torch.no_grad():
+        for data, label in testloader:
+            data = data.to(device)
+            base = torch.cat([F.softmax(net(chunk.permute(0, 2, 1)), dim=1) for chunk in data.split(chunk_size)])
+            batches.append((data, label.view(-1), base))
+    return batches
+
+
+def voting_repeat(net, batches, seed, num_vote, chunk_size, pointscale):
+    """
+    One repeat of the voting evaluation with its own random stream.
+    Return:
+        test_acc, test_mean_acc
+    """
+    rng = np.random.default_rng(seed)
+    test_true = []
+    test_pred = []
+    for data, label, base in batches:
+        # all votes of the batch are stacked into B * (NUM_VOTE - 1) clouds and scored together
+        scales = torch.from_numpy(pointscale.sample(data.size(0), num_vote, rng)).float().to(data.device)
+        with torch.no_grad():
+            pred = vote_scores(net, data, scales, chunk_size, base)  # avg the preds!
+        test_true.append(label.numpy())
+        test_pred.append(pred.max(dim=1)[1].cpu().numpy())
+    test_true = np.concatenate(test_true)
+    test_pred = np.concatenate(test_pred)
+    return 100. * metrics.accuracy_score(test_true, test_pred), 100. * metrics.balanced_accuracy_score(test_true, test_pred)
+
+
+_voting_worker = {}
+
+
+def init_voting_worker(net, batches, num_vote, chunk_size, pointscale, counter, threads):
+    # every process of the pool takes the next GPU, or a share of the CPU cores, and keeps its own copy
+    with counter.get_lock():
+        rank = counter.value
+        counter.value += 1
+    device = 'cuda:%d' % (rank % torch.cuda.device_count()) if torch.cuda.is_available() else 'cpu'
+    torch.set_num_threads(threads)
+    _voting_worker.update(net=net.to(device).eval(), num_vote=num_vote, chunk_size=chunk_size, pointscale=pointscale,
+                          batches=[(data.to(device), label, base.to(device)) for data, label, base in batches])
+
+
+def run_voting_repeat(task):
+    i, seed = task
+    worker = _voting_worker
+    return (i,) + voting_repeat(worker['net'], worker['batches'], seed, worker['num_vote'], worker['chunk_size'],
+                                worker['pointscale'])
+
 
 def main():
     args = parse_args()
@@ -156,30 +268,27 @@ def voting(net, testloader, device, args):
     # pointscale = PointcloudScale(scale_low=0.8, scale_high=1.18)  # set the range of scaling
     # pointscale = PointcloudScale()
     pointscale = PointcloudScale(scale_low=0.85, scale_high=1.15)
+    chunk_size = args.vote_chunk
+    if chunk_size is None:
+        chunk_size = vote_chunk_size(net, next(iter(testloader))[0].to(device))
+    batches = voting_batches(net, testloader, device, chunk_size)
+    # the repeats are independent, each gets its own random stream
+    tasks = list(enumerate(np.random.SeedSequence(args.seed).spawn(args.NUM_PEPEAT)))
 
-    for i in range(args.NUM_PEPEAT):
-        test_true = []
-        test_pred = []
+    if args.vote_workers > 1:
+        module = net.module if isinstance(net, torch.nn.DataParallel) else net
+        ctx = torch.multiprocessing.get_context('spawn')
+        threads = max(1, torch.get_num_threads() // args.vote_workers)
+        pool = ctx.Pool(args.vote_workers, initializer=init_voting_worker, initargs=(
+            copy.deepcopy(module).cpu(), [(data.cpu(), label, base.cpu()) for data, label, base in batches], args.NUM_VOTE,
+            chunk_size, pointscale, ctx.Value('i', 0), threads))
+        results = pool.imap(run_voting_repeat, tasks)
+    else:
+        pool = None
+        results = ((i,) + voting_repeat(net, batches, seed, args.NUM_VOTE, chunk_size, pointscale)
+                   for i, seed in tasks)
 
-        for batch_idx, (data, label) in enumerate(testloader):
-            data, label = data.to(device), label.to(device).squeeze()
-            pred = 0
-            for v in range(args.NUM_VOTE):
-                new_data = data
-                # batch_size = data.size()[0]
-                if v > 0:
-                    new_data.data = pointscale(new_data.data)
-                with torch.no_grad():
-                    pred += F.softmax(net(new_data.permute(0, 2, 1)), dim=1)  # sum 10 preds
-            pred /= args.NUM_VOTE  # avg the preds!
-            label = label.view(-1)
-            pred_choice = pred.max(dim=1)[1]
-            test_true.append(label.cpu().numpy())
-            test_pred.append(pred_choice.detach().cpu().numpy())
-        test_true = np.concatenate(test_true)
-        test_pred = np.concatenate(test_pred)
-        test_acc = 100. * metrics.accuracy_score(test_true, test_pred)
-        test_mean_acc = 100. * metrics.balanced_accuracy_score(test_true, test_pred)
+    for i, test_acc, test_mean_acc in results:
         if test_acc > best_acc:
             best_acc = test_acc
         if test_mean_acc > best_mean_acc:
@@ -187,6 +296,9 @@ def voting(net, testloader, device, args):
         outstr = 'Voting %d, test acc: %.3f, test mean acc: %.3f,  [current best(all_acc: %.3f mean_acc: %.3f)]' % \
                  (i, test_acc, test_mean_acc, best_acc, best_mean_acc)
         io.cprint(outstr)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     final_outstr = 'Final voting test acc: %.6f,' % (best_acc * 100)
     io.cprint(final_outstr)
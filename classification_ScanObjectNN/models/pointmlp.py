@@ -1,7 +1,15 @@
 
+import copy
+import warnings
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 # from torch import einsum
 # from einops import rearrange, repeat
 
@@ -42,9 +50,12 @@ def square_distance(src, dst):
     """
     B, N, _ = src.shape
     _, M, _ = dst.shape
-    dist = -2 * torch.matmul(src, dst.permute(0, 2, 1))
-    dist += torch.sum(src ** 2, -1).view(B, N, 1)
-    dist += torch.sum(dst ** 2, -1).view(B, 1, M)
+    # kept in fp32 under autocast, the expansion cancels catastrophically in half precision
+    with torch.autocast(src.device.type, enabled=False):
+        src, dst = src.float(), dst.float()
+        dist = -2 * torch.matmul(src, dst.permute(0, 2, 1))
+        dist += torch.sum(src ** 2, -1).view(B, N, 1)
+        dist += torch.sum(dst ** 2, -1).view(B, 1, M)
     return dist
 
 
@@ -67,29 +78,122 @@ def index_points(points, idx):
     return new_points
 
 
-def farthest_point_sample(xyz, npoint):
+# the pointnet2_ops FPS as a custom operator (torch>=2.4), torch.compile keeps it in the graph instead of breaking
+# on the extension call, every copy of this file shares the registration
+if hasattr(torch.library, "custom_op") and not hasattr(torch.ops.pointmlp, "furthest_point_sample"):
+    @torch.library.custom_op("pointmlp::furthest_point_sample", mutates_args=())
+    def _furthest_point_sample(xyz: torch.Tensor, npoint: int) -> torch.Tensor:
+        return pointnet2_utils.furthest_point_sample(xyz.contiguous(), npoint).long()
+
+    @_furthest_point_sample.register_fake
+    def _(xyz, npoint):
+        return xyz.new_empty((xyz.size(0), npoint), dtype=torch.long)
+
+
+def furthest_point_sample_op(xyz, npoint):
+    """
+    Input:
+        xyz: pointcloud data, [B, N, 3]
+        npoint: number of samples
+    Return:
+        centroids: sampled pointcloud index of pointnet2_ops, [B, npoint]
+    """
+    if hasattr(torch.library, "custom_op"):
+        return torch.ops.pointmlp.furthest_point_sample(xyz, npoint)
+    return pointnet2_utils.furthest_point_sample(xyz.contiguous(), npoint).long()
+
+
+def farthest_point_sample(xyz, npoint, approximate=False):
     """
     Input:
         xyz: pointcloud data, [B, N, 3]
         npoint: number of samples
+        approximate: run the FPS on a grid subsample of the cloud, see grid_farthest_point_sample
     Return:
         centroids: sampled pointcloud index, [B, npoint]
     """
-    device = xyz.device
+    if approximate:
+        return grid_farthest_point_sample(xyz, npoint)
+    B, N, C = xyz.shape
+    farthest = torch.randint(0, N, (B,), dtype=torch.long, device=xyz.device)
+    return _farthest_point_sample(xyz.contiguous(), farthest, npoint)
+
+
+_scripted_farthest_point_sample = None
+
+
+def _farthest_point_sample(xyz, farthest, npoint: int):
+    # torch.jit.script runs the npoint iterations without the python interpreter, it is only used on torch
+    # versions without torch.compile, where it is not deprecated, and scripted on first use so that
+    # importing the model stays quiet
+    global _scripted_farthest_point_sample
+    if hasattr(torch, "compile"):
+        return _farthest_point_sample_loop(xyz, farthest, npoint)
+    if _scripted_farthest_point_sample is None:
+        _scripted_farthest_point_sample = torch.jit.script(_farthest_point_sample_loop)
+    return _scripted_farthest_point_sample(xyz, farthest, npoint)
+
+
+def _farthest_point_sample_loop(xyz, farthest, npoint: int):
+    # the points are kept planar and the distances are updated in place to avoid allocations in the loop
     B, N, C = xyz.shape
-    centroids = torch.zeros(B, npoint, dtype=torch.long).to(device)
-    distance = torch.ones(B, N).to(device) * 1e10
-    farthest = torch.randint(0, N, (B,), dtype=torch.long).to(device)
-    batch_indices = torch.arange(B, dtype=torch.long).to(device)
+    centroids = torch.zeros(B, npoint, dtype=torch.long, device=xyz.device)
+    distance = torch.full((B, N), 1e10, dtype=xyz.dtype, device=xyz.device)
+    dist = torch.empty_like(distance)
+    planar = xyz.transpose(1, 2).contiguous()  # [B, C, N]
     for i in range(npoint):
         centroids[:, i] = farthest
-        centroid = xyz[batch_indices, farthest, :].view(B, 1, 3)
-        dist = torch.sum((xyz - centroid) ** 2, -1)
-        distance = torch.min(distance, dist)
+        centroid = torch.gather(planar, 2, farthest.view(B, 1, 1).expand(B, C, 1))
+        diff = planar - centroid
+        torch.sum(diff.mul_(diff), 1, out=dist)
+        torch.minimum(distance, dist, out=distance)
         farthest = torch.max(distance, -1)[1]
     return centroids
 
 
+def grid_farthest_point_sample(xyz, npoint, ratio=4, grid_size=None):
+    """
+    Approximate FPS: keep one random point per occupied cell of a randomly shifted voxel grid and
+    run the exact FPS on those (about ratio * npoint) points only.
+    Input:
+        xyz: pointcloud data, [B, N, 3]
+        npoint: number of samples
+        ratio: targeted number of candidates per sample, sets the cell size when grid_size is None
+        grid_size: cell size of the grid, [B] or float
+    Return:
+        centroids: sampled pointcloud index, [B, npoint]
+    """
+    B, N, C = xyz.shape
+    if N <= ratio * npoint:
+        return farthest_point_sample(xyz, npoint)
+    lower = xyz.min(1, keepdim=True)[0]
+    if grid_size is None:
+        # point clouds are sampled surfaces, the occupied cells grow with (extent / cell size) ** 2
+        extent = (xyz.max(1, keepdim=True)[0] - lower).norm(dim=-1, keepdim=True)
+        grid_size = extent / (ratio * npoint) ** 0.5
+    else:
+        grid_size = torch.as_tensor(grid_size, dtype=xyz.dtype, device=xyz.device).view(-1, 1, 1)
+    grid_size = grid_size.clamp(min=1e-12)
+    cells = ((xyz - lower) / grid_size + torch.rand(B, 1, C, device=xyz.device)).long()  # [B, N, 3]
+    cells = cells.clamp(max=2 ** 20 - 1)
+    keys = (cells[..., 0] << 40) | (cells[..., 1] << 20) | cells[..., 2]
+    # shuffle, then stable sort by cell: the first point of each cell is a random representative
+    priority = torch.rand(B, N, device=xyz.device)
+    order = torch.argsort(priority, dim=-1)
+    sorted_keys, perm = torch.sort(torch.gather(keys, 1, order), dim=-1, stable=True)
+    order = torch.gather(order, 1, perm)
+    first = torch.ones_like(sorted_keys, dtype=torch.bool)
+    first[:, 1:] = sorted_keys[:, 1:] != sorted_keys[:, :-1]
+    representative = torch.zeros_like(first).scatter_(1, order, first)
+    # representatives first, then the others in random order to pad the batch to the same size
+    M = max(int(representative.sum(-1).max()), npoint)
+    candidates = torch.argsort(representative.float() + priority * 0.5, dim=-1, descending=True)[:, :M]
+    new_xyz = torch.gather(xyz, 1, candidates.unsqueeze(-1).expand(B, M, C))
+    farthest = torch.randint(0, M, (B,), dtype=torch.long, device=xyz.device)
+    centroids = _farthest_point_sample(new_xyz.contiguous(), farthest, npoint)
+    return torch.gather(candidates, 1, centroids)
+
+
 def query_ball_point(radius, nsample, xyz, new_xyz):
     """
     Input:
@@ -113,57 +217,390 @@ def query_ball_point(radius, nsample, xyz, new_xyz):
     return group_idx
 
 
-def knn_point(nsample, xyz, new_xyz):
+def knn_point(nsample, xyz, new_xyz, max_elements=None):
     """
     Input:
         nsample: max sample number in local region
         xyz: all points, [B, N, C]
         new_xyz: query points, [B, S, C]
+        max_elements: optional budget of pairwise distances held at once, see chunked_knn_point
     Return:
         group_idx: grouped points index, [B, S, nsample]
     """
+    B, N, _ = xyz.shape
+    _, S, _ = new_xyz.shape
+    if max_elements is not None and B * S * N > max_elements:
+        return chunked_knn_point(nsample, xyz, new_xyz, max_elements)
     sqrdists = square_distance(new_xyz, xyz)
     _, group_idx = torch.topk(sqrdists, nsample, dim=-1, largest=False, sorted=False)
     return group_idx
 
 
+def chunked_knn_point(nsample, xyz, new_xyz, max_elements):
+    """
+    Memory-bounded knn_point: the queries are processed in blocks, and when one query row against
+    all points exceeds the budget the points are scanned in tiles while a running top-k is kept.
+    Roughly max_elements distances are alive at a time instead of the dense [B, S, N] matrix.
+    Input:
+        nsample: max sample number in local region
+        xyz: all points, [B, N, C]
+        new_xyz: query points, [B, S, C]
+        max_elements: budget of pairwise distances held at once
+    Return:
+        group_idx: grouped points index, [B, S, nsample]
+    """
+    B, N, _ = xyz.shape
+    _, S, _ = new_xyz.shape
+    tile = N if B * N <= max_elements else max(nsample, max_elements // B - nsample)  # points per tile
+    width = N if tile == N else tile + nsample  # candidates per query (tile + running top-k)
+    block = max(1, min(S, max_elements // (B * width)))  # queries per block
+    group_idx = torch.empty(B, S, nsample, dtype=torch.long, device=xyz.device)
+    for s in range(0, S, block):
+        queries = new_xyz[:, s:s + block]
+        best_dist, best_idx = None, None
+        for n in range(0, N, tile):
+            dists = square_distance(queries, xyz[:, n:n + tile])
+            idx = torch.arange(n, n + dists.shape[-1], device=xyz.device).expand_as(dists)
+            if best_dist is not None:
+                dists = torch.cat([best_dist, dists], dim=-1)
+                idx = torch.cat([best_idx, idx], dim=-1)
+            best_dist, pos = torch.topk(dists, min(nsample, dists.shape[-1]), dim=-1, largest=False, sorted=False)
+            best_idx = torch.gather(idx, -1, pos)
+        group_idx[:, s:s + block] = best_idx
+    return group_idx
+
+
+def spread_bits(x):
+    """
+    Inserts two zero bits between each of the lowest 21 bits of x, the building block of 3D Morton codes.
+    Input:
+        x: integer coordinates, int64 tensor of any shape
+    Return:
+        spread: int64 tensor of the same shape
+    """
+    x = x & 0x1fffff
+    x = (x | (x << 32)) & 0x1f00000000ffff
+    x = (x | (x << 16)) & 0x1f0000ff0000ff
+    x = (x | (x << 8)) & 0x100f00f00f00f00f
+    x = (x | (x << 4)) & 0x10c30c30c30c30c3
+    x = (x | (x << 2)) & 0x1249249249249249
+    return x
+
+
+class MortonIndex(object):
+    def __init__(self, xyz, window=64, shifts=3, bits=16, max_elements=2 ** 22):
+        """
+        Approximate kNN index for large point clouds, built once per cloud and reusable across stages.
+        The points are sorted along the Morton (z-order) curves of a few shifted copies of the cloud and
+        a query only measures the `window` points around its own position on each curve, so building
+        is O(N log N) and each query O(window * shifts) instead of O(N).
+        :param xyz: indexed points, [B, N, 3]
+        :param window: candidates per curve and query (at least 2 * k are used)
+        :param shifts: number of shifted curves, more curves recover neighbours split by curve jumps
+        :param bits: grid resolution per axis
+        :param max_elements: budget of candidate points gathered at once while querying
+        """
+        self.xyz = xyz.contiguous()
+        self.window = window
+        self.shifts = shifts
+        self.bits = bits
+        self.max_elements = max_elements
+        self.coord_min = xyz.min(dim=1, keepdim=True)[0]  # [B, 1, 3]
+        extent = (xyz.max(dim=1, keepdim=True)[0] - self.coord_min).max(dim=-1, keepdim=True)[0]
+        extent = extent.clamp_min(1e-6)  # [B, 1, 1]
+        self.cell = extent * 1.5 / (2 ** bits)  # leaves room for the shifted copies
+        self.offsets = [extent * 0.5 * i / shifts for i in range(shifts)]
+        self.codes, self.orders = [], []
+        for offset in self.offsets:
+            codes, order = self.encode(xyz, offset).sort(dim=-1)
+            self.codes.append(codes)
+            self.orders.append(order)
+
+    def encode(self, xyz, offset):
+        grid = ((xyz - self.coord_min + offset) / self.cell).long().clamp_(0, 2 ** self.bits - 1)
+        return spread_bits(grid[..., 0]) | (spread_bits(grid[..., 1]) << 1) | (spread_bits(grid[..., 2]) << 2)
+
+    def knn(self, new_xyz, k):
+        """
+        Input:
+            new_xyz: query points, [B, S, 3]
+            k: number of neighbours
+        Return:
+            dists: squared distances in ascending order, [B, S, k]
+            idx: neighbour indices, [B, S, k]
+        """
+        B, N, _ = self.xyz.shape
+        _, S, _ = new_xyz.shape
+        window = min(N, max(self.window, 2 * k))
+        block = max(1, self.max_elements // (B * window * self.shifts))  # queries per block
+        steps = torch.arange(window, device=new_xyz.device)
+        dists = new_xyz.new_empty(B, S, k)
+        idx = torch.empty(B, S, k, dtype=torch.long, device=new_xyz.device)
+        for s in range(0, S, block):
+            queries = new_xyz[:, s:s + block]
+            candidates = []
+            for offset, codes, order in zip(self.offsets, self.codes, self.orders):
+                pos = torch.searchsorted(codes, self.encode(queries, offset).contiguous())
+                start = (pos - window // 2).clamp(0, N - window)
+                window_idx = (start.unsqueeze(-1) + steps).view(B, -1)
+                candidates.append(torch.gather(order, 1, window_idx).view(B, -1, window))
+            candidates = torch.cat(candidates, dim=-1).sort(dim=-1)[0]  # [B, block, shifts * window]
+            cand_dists = torch.sum((index_points(self.xyz, candidates) - queries.unsqueeze(2)) ** 2, dim=-1)
+            # shifted curves may propose the same point more than once
+            duplicate = torch.zeros_like(candidates, dtype=torch.bool)
+            duplicate[..., 1:] = candidates[..., 1:] == candidates[..., :-1]
+            cand_dists = cand_dists.masked_fill(duplicate, float('inf'))
+            block_dists, pos = torch.topk(cand_dists, k, dim=-1, largest=False, sorted=True)
+            dists[:, s:s + block] = block_dists
+            idx[:, s:s + block] = torch.gather(candidates, -1, pos)
+        return dists, idx
+
+
+class GroupingCache(object):
+    def __init__(self, max_bytes=2 ** 28, max_ghosts=2 ** 17):
+        """
+        Content-keyed LRU cache of the (fps_idx, knn idx) of every sample and stage, shared by the
+        LocalGroupers of a model and used in eval mode. A cloud is only admitted the second time it
+        is seen, so randomly augmented clouds (e.g. voting scales) do not evict the recurring ones.
+        :param max_bytes: memory cap of the cached indices
+        :param max_ghosts: number of keys remembered for the admission of clouds seen once
+        """
+        self.max_bytes = max_bytes
+        self.max_ghosts = max_ghosts
+        self.entries = OrderedDict()
+        self.ghosts = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # replicas of nn.DataParallel share the cache across threads
+
+    def __getstate__(self):
+        # copies and pickles of a model start with an empty cache
+        return {"max_bytes": self.max_bytes, "max_ghosts": self.max_ghosts}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def digest(xyz):
+        xyz = xyz.detach().cpu().contiguous().numpy()
+        return [hashlib.sha1(cloud.tobytes()).hexdigest() for cloud in xyz]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        size = sum(t.element_size() * t.numel() for t in entry)
+        with self.lock:
+            if key in self.entries or size > self.max_bytes:
+                return
+            if key not in self.ghosts:
+                self.ghosts[key] = None
+                while len(self.ghosts) > self.max_ghosts:
+                    self.ghosts.popitem(last=False)
+                return
+            del self.ghosts[key]
+            self.entries[key] = entry
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= sum(t.element_size() * t.numel() for t in evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.ghosts.clear()
+            self.bytes = 0
+
+
+class FusedGrouping(torch.autograd.Function):
+    """
+    Gathers the neighbours of the anchors, normalizes them and concatenates the anchor features in
+    one op. Only the inputs and the per-sample std are saved, the backward recomputes the grouped
+    features once instead of keeping every [B, S, K, D] intermediate of the unfused version alive.
+    Written with plain tensor ops, so the same code runs on CPU and CUDA.
+    """
+
+    @staticmethod
+    def group(xyz, points, fps_idx, idx, normalize, use_xyz):
+        # returns the centered neighbours [B, S, K, D'] and the anchor features [B, S, d]
+        new_points = index_points(points, fps_idx)
+        grouped = index_points(points, idx)
+        if use_xyz:
+            grouped = torch.cat([grouped, index_points(xyz, idx)], dim=-1)
+        if normalize == "center":
+            grouped -= grouped.mean(dim=2, keepdim=True)
+        else:
+            anchor = torch.cat([new_points, index_points(xyz, fps_idx)], dim=-1) if use_xyz else new_points
+            grouped -= anchor.unsqueeze(dim=-2)
+        return grouped, new_points
+
+    @staticmethod
+    def forward(ctx, xyz, points, fps_idx, idx, alpha, beta, normalize, use_xyz, concat=True):
+        B, S, K = idx.shape
+        grouped, new_points = FusedGrouping.group(xyz, points, fps_idx, idx, normalize, use_xyz)
+        std = torch.std(grouped.view(B, -1), dim=-1).view(B, 1, 1, 1)
+        grouped = torch.addcmul(beta, alpha, grouped.div_(std + 1e-5))
+        ctx.save_for_backward(xyz, points, fps_idx, idx, alpha, std)
+        ctx.normalize, ctx.use_xyz, ctx.concat = normalize, use_xyz, concat
+        if not concat:
+            return grouped
+        return torch.cat([grouped, new_points.unsqueeze(dim=-2).expand(-1, -1, K, -1)], dim=-1)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        xyz, points, fps_idx, idx, alpha, std = ctx.saved_tensors
+        B, S, K = idx.shape
+        d = points.shape[-1]
+        grouped, _ = FusedGrouping.group(xyz, points, fps_idx, idx, ctx.normalize, ctx.use_xyz)
+        grouped.div_(std + 1e-5)  # normalized features before the affine transform
+        grad_grouped = grad_out[..., :alpha.shape[-1]]
+        grad_alpha = (grad_grouped * grouped).sum(dim=(0, 1, 2), keepdim=True)
+        grad_beta = grad_grouped.sum(dim=(0, 1, 2), keepdim=True)
+
+        # through the division by std + eps, with std the unbiased std over each sample
+        grad = grad_grouped * alpha
+        M = grouped[0].numel()
+        centered = grouped.view(B, -1)
+        dot = (grad.reshape(B, -1) * centered).sum(dim=-1)  # sum(grad * c) / (std + eps)
+        centered = centered - centered.mean(dim=-1, keepdim=True)  # (c - mean(c)) / (std + eps)
+        coeff = dot / ((M - 1) * std.view(B)).clamp(min=1e-12)
+        grad = grad / (std + 1e-5) - coeff.view(B, 1, 1, 1) * centered.view_as(grad)
+
+        if ctx.normalize == "center":
+            grad_anchor = None
+            grad = grad - grad.mean(dim=2, keepdim=True)
+        else:
+            grad_anchor = -grad.sum(dim=2)
+        grad_new_points = grad_out[..., -d:].sum(dim=2) if ctx.concat else None
+        if grad_anchor is not None:
+            grad_new_points = grad_anchor[..., :d] if grad_new_points is None else grad_new_points + grad_anchor[..., :d]
+
+        grad_points = torch.zeros_like(points)
+        grad_points.scatter_add_(1, idx.view(B, -1, 1).expand(-1, -1, d), grad[..., :d].reshape(B, -1, d))
+        if grad_new_points is not None:
+            grad_points.scatter_add_(1, fps_idx.unsqueeze(-1).expand(-1, -1, d), grad_new_points)
+        grad_xyz = None
+        if ctx.use_xyz and ctx.needs_input_grad[0]:
+            grad_xyz = torch.zeros_like(xyz)
+            grad_xyz.scatter_add_(1, idx.view(B, -1, 1).expand(-1, -1, 3), grad[..., d:].reshape(B, -1, 3))
+            if grad_anchor is not None:
+                grad_xyz.scatter_add_(1, fps_idx.unsqueeze(-1).expand(-1, -1, 3), grad_anchor[..., d:])
+        return grad_xyz, grad_points, None, None, grad_alpha, grad_beta, None, None, None
+
+
 class LocalGrouper(nn.Module):
-    def __init__(self, channel, groups, kneighbors, use_xyz=True, normalize="center", **kwargs):
+    def __init__(self, channel, groups, kneighbors, use_xyz=True, normalize="center", knn_max_elements=None,
+                 knn_index=None, cache=None, fused=True, concat_anchor=True, **kwargs):
         """
         Give xyz[b,p,3] and fea[b,p,d], return new_xyz[b,g,3] and new_fea[b,g,k,d]
         :param groups: groups number
         :param kneighbors: k-nerighbors
+        :param knn_max_elements: distance budget of the kNN search, None for the dense search
+        :param knn_index: None for the exact kNN search, "morton" for the approximate MortonIndex
+        :param cache: optional GroupingCache reused for the fps/knn indices in eval mode
+        :param fused: normalize and concatenate the groups with FusedGrouping to save memory
+        :param concat_anchor: concatenate the anchor features to every neighbour, otherwise return
+            new_fea as ([b,g,k,d], [b,g,d]) for PreExtraction with split_transfer
         :param kwargs: others
         """
         super(LocalGrouper, self).__init__()
         self.groups = groups
         self.kneighbors = kneighbors
         self.use_xyz = use_xyz
+        self.knn_max_elements = knn_max_elements
+        assert knn_index in [None, "morton"], "Unrecognized knn_index, should be one of [None, morton]."
+        self.knn_index = knn_index
+        self.fused = fused
+        self.concat_anchor = concat_anchor
+        self.cache = cache
         if normalize is not None:
             self.normalize = normalize.lower()
         else:
             self.normalize = None
-        if self.normalize not in ["center", "anchor"]:
-            print(f"Unrecognized normalize parameter (self.normalize), set to None. Should be one of [center, anchor].")
+        if self.normalize not in [None, "center", "anchor"]:
+            warnings.warn(f"Unrecognized normalize parameter {normalize}, set to None. "
+                          f"Should be one of [center, anchor].")
             self.normalize = None
         if self.normalize is not None:
             add_channel=3 if self.use_xyz else 0
             self.affine_alpha = nn.Parameter(torch.ones([1,1,1,channel + add_channel]))
             self.affine_beta = nn.Parameter(torch.zeros([1, 1, 1, channel + add_channel]))
 
-    def forward(self, xyz, points):
-        B, N, C = xyz.shape
-        S = self.groups
-        xyz = xyz.contiguous()  # xyz [btach, points, xyz]
+    def build_index(self, xyz):
+        return MortonIndex(xyz) if self.knn_index == "morton" else None
+
+    def sample(self, xyz, index=None):
+        """
+        Input:
+            xyz: input points position data, [B, N, 3]
+        Return:
+            fps_idx: sampled anchor index, [B, S]
+            idx: grouped neighbour index of every anchor, [B, S, K]
+        """
+        xyz = xyz.float().contiguous()
+        if self.cache is not None and not self.training:
+            return self.cached_grouping(xyz, index)
+        return self.grouping(xyz, index)
 
+    def grouping(self, xyz, index=None):
         # fps_idx = torch.multinomial(torch.linspace(0, N - 1, steps=N).repeat(B, 1).to(xyz.device), num_samples=self.groups, replacement=False).long()
         # fps_idx = farthest_point_sample(xyz, self.groups).long()
-        fps_idx = pointnet2_utils.furthest_point_sample(xyz, self.groups).long()  # [B, npoint]
+        fps_idx = furthest_point_sample_op(xyz, self.groups)  # [B, npoint]
         new_xyz = index_points(xyz, fps_idx)  # [B, npoint, 3]
-        new_points = index_points(points, fps_idx)  # [B, npoint, d]
 
-        idx = knn_point(self.kneighbors, xyz, new_xyz)
+        if self.knn_index is not None:
+            index = self.build_index(xyz) if index is None else index  # may be shared with other stages
+            _, idx = index.knn(new_xyz, self.kneighbors)
+        else:
+            idx = knn_point(self.kneighbors, xyz, new_xyz, self.knn_max_elements)
         # idx = query_ball_point(radius, nsample, xyz, new_xyz)
+        return fps_idx, idx
+
+    def cached_grouping(self, xyz, index=None):
+        keys = [(self.groups, self.kneighbors, digest) for digest in self.cache.digest(xyz)]
+        entries = [self.cache.get(key) for key in keys]
+        miss = [b for b, entry in enumerate(entries) if entry is None]
+        if len(miss) > 0:
+            # an index built over the whole batch does not match a subset of it
+            fps_idx, idx = self.grouping(xyz[miss], index if len(miss) == len(keys) else None)
+            for i, b in enumerate(miss):
+                entries[b] = (fps_idx[i].int(), idx[i].int())
+                self.cache.put(keys[b], entries[b])
+        # the replicas of nn.DataParallel share the cache, an entry may come from another device
+        fps_idx = torch.stack([entry[0].to(xyz.device) for entry in entries]).long()
+        idx = torch.stack([entry[1].to(xyz.device) for entry in entries]).long()
+        return fps_idx, idx
+
+    def forward(self, xyz, points, index=None, indices=None):
+        """
+        :param indices: (fps_idx, idx) of sample() to group with, e.g. replayed by a checkpointed stage
+        """
+        # the grouping and the std normalization run in fp32, also under autocast
+        with torch.autocast(xyz.device.type, enabled=False):
+            return self.forward_fp32(xyz.float(), points.float(), index, indices)
+
+    def forward_fp32(self, xyz, points, index=None, indices=None):
+        B, N, C = xyz.shape
+        S = self.groups
+        xyz = xyz.contiguous()  # xyz [btach, points, xyz]
+
+        fps_idx, idx = self.sample(xyz, index) if indices is None else indices
+        new_xyz = index_points(xyz, fps_idx)  # [B, npoint, 3]
+        new_points = index_points(points, fps_idx)  # [B, npoint, d]
+        if self.normalize is not None and self.fused:
+            grouped_points = FusedGrouping.apply(xyz, points, fps_idx, idx, self.affine_alpha, self.affine_beta,
+                                                 self.normalize, self.use_xyz, self.concat_anchor)
+            if self.concat_anchor:
+                return new_xyz, grouped_points  # [B, npoint, k, d+3+d]
+            return new_xyz, (grouped_points, new_points)  # [B, npoint, k, d+3], [B, npoint, d]
         grouped_xyz = index_points(xyz, idx)  # [B, npoint, k, 3]
         grouped_points = index_points(points, idx)  # [B, npoint, k, d]
         if self.use_xyz:
@@ -178,10 +615,97 @@ class LocalGrouper(nn.Module):
             grouped_points = (grouped_points-mean)/(std + 1e-5)
             grouped_points = self.affine_alpha*grouped_points + self.affine_beta #todo
 
+        if not self.concat_anchor:
+            return new_xyz, (grouped_points, new_points)
         new_points = torch.cat([grouped_points, new_points.view(B, S, 1, -1).repeat(1, 1, self.kneighbors, 1)], dim=-1)
         return new_xyz, new_points
 
 
+def fuse_conv_bn(layer, bn):
+    """
+    Input:
+        layer: nn.Conv1d or nn.Linear
+        bn: nn.BatchNorm1d applied to the output of layer
+    Return:
+        fused: copy of layer with the running statistics and affine transform of bn folded in
+    """
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        scale, shift = scale * bn.weight, shift * bn.weight + bn.bias
+    fused = copy.deepcopy(layer)
+    weight = layer.weight * scale.view(-1, *([1] * (layer.weight.dim() - 1)))
+    bias = shift if layer.bias is None else layer.bias * scale + shift
+    fused.weight = nn.Parameter(weight.detach())
+    fused.bias = nn.Parameter(bias.detach())
+    return fused
+
+
+def fuse_bn_layers(module):
+    """
+    Replaces every (Conv1d/Linear, BatchNorm1d) pair of the nn.Sequential in module by the fused layer and an
+    nn.Identity, so the indices of the remaining layers do not change. Only valid in eval mode.
+    """
+    for child in module.children():
+        if isinstance(child, nn.Sequential):
+            for i in range(len(child) - 1):
+                if isinstance(child[i], (nn.Conv1d, nn.Linear)) and isinstance(child[i + 1], nn.BatchNorm1d):
+                    child[i] = fuse_conv_bn(child[i], child[i + 1])
+                    child[i + 1] = nn.Identity()
+        fuse_bn_layers(child)
+    return module
+
+
+@contextmanager
+def frozen_bn_stats(*modules):
+    """
+    Keeps the running statistics of the BatchNorm layers in modules unchanged, for the recomputation
+    of a checkpointed block, which would otherwise count the batch twice.
+    """
+    state = [(bn, bn.momentum, bn.num_batches_tracked.clone()) for module in modules for bn in module.modules()
+             if isinstance(bn, nn.modules.batchnorm._BatchNorm) and bn.track_running_stats]
+    for bn, _, _ in state:
+        bn.momentum = 0.
+    try:
+        yield
+    finally:
+        for bn, momentum, num_batches_tracked in state:
+            bn.momentum = momentum
+            bn.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def checkpoint_modules(modules, function, *inputs):
+    """
+    Runs function(*inputs) with torch.utils.checkpoint, the activations are recomputed in backward instead of
+    stored. The BatchNorm statistics of modules are only updated by the forward pass, not by the recomputation.
+    """
+    recompute = []
+
+    def run(*inputs):
+        # the first call is the forward pass, every later one a recomputation in backward
+        with frozen_bn_stats(*modules) if recompute else nullcontext():
+            recompute.append(True)
+            return function(*inputs)
+    return checkpoint(run, *inputs, use_reentrant=False)
+
+
+def checkpoint_stage(local_grouper, pre_block, xyz, points, index=None):
+    """
+    LocalGrouper + PreExtraction without keeping the [b,g,k,d] groups for backward, they are recomputed from
+    points. The fps/knn indices are sampled once outside the checkpoint, so the recomputation replays the same
+    groups and the neighbour search is not run twice.
+    Input:
+        xyz: [b,p,3], points: [b,p,d]
+    Return:
+        new_xyz: [b,g,3], new_points: [b,d',g]
+    """
+    indices = local_grouper.sample(xyz, index)
+    new_xyz = index_points(xyz.float().contiguous(), indices[0])
+    new_points = checkpoint_modules([local_grouper, pre_block],
+                                    lambda points: pre_block(local_grouper(xyz, points, index, indices)[1]), points)
+    return new_xyz, new_points
+
+
 class ConvBNReLU1D(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=1, bias=True, activation='relu'):
         super(ConvBNReLU1D, self).__init__()
@@ -229,14 +753,17 @@ class ConvBNReLURes1D(nn.Module):
 
 class PreExtraction(nn.Module):
     def __init__(self, channels, out_channels,  blocks=1, groups=1, res_expansion=1, bias=True,
-                 activation='relu', use_xyz=True):
+                 activation='relu', use_xyz=True, split_transfer=False):
         """
         input: [b,g,k,d]: output:[b,d,g]
         :param channels:
         :param blocks:
+        :param split_transfer: take the input as ([b,g,k,d+3], [b,g,d]) and apply the anchor columns of the
+            transfer conv once per group instead of to the repeated anchor features, same weights
         """
         super(PreExtraction, self).__init__()
         in_channels = 3+2*channels if use_xyz else 2*channels
+        self.split_transfer = split_transfer
         self.transfer = ConvBNReLU1D(in_channels, out_channels, bias=bias, activation=activation)
         operation = []
         for _ in range(blocks):
@@ -247,10 +774,26 @@ class PreExtraction(nn.Module):
         self.operation = nn.Sequential(*operation)
 
     def forward(self, x):
+        if self.split_transfer:
+            return self.forward_split(*x)
         b, n, s, d = x.size()  # torch.Size([32, 512, 32, 6])
         x = x.permute(0, 1, 3, 2)
         x = x.reshape(-1, d, s)
         x = self.transfer(x)
+        return self.forward_operation(x, b, n)
+
+    def forward_split(self, x, anchor):
+        b, n, s, d = x.size()
+        conv = self.transfer.net[0]
+        x = x.permute(0, 1, 3, 2)
+        x = x.reshape(-1, d, s)
+        # conv(cat([x, anchor])) == conv_x(x) + conv_anchor(anchor), the latter broadcast over the k neighbours
+        x = F.conv1d(x, conv.weight[:, :d], conv.bias)
+        x = x + F.linear(anchor.reshape(b * n, -1), conv.weight[:, d:, 0]).unsqueeze(dim=-1)
+        x = self.transfer.net[2](self.transfer.net[1](x))
+        return self.forward_operation(x, b, n)
+
+    def forward_operation(self, x, b, n):
         batch_size, _, _ = x.size()
         x = self.operation(x)  # [b, d, k]
         x = F.adaptive_max_pool1d(x, 1).view(batch_size, -1)
@@ -281,14 +824,24 @@ class Model(nn.Module):
     def __init__(self, points=1024, class_num=40, embed_dim=64, groups=1, res_expansion=1.0,
                  activation="relu", bias=True, use_xyz=True, normalize="center",
                  dim_expansion=[2, 2, 2, 2], pre_blocks=[2, 2, 2, 2], pos_blocks=[2, 2, 2, 2],
-                 k_neighbors=[32, 32, 32, 32], reducers=[2, 2, 2, 2], **kwargs):
+                 k_neighbors=[32, 32, 32, 32], reducers=[2, 2, 2, 2], knn_max_elements=None, knn_index=None,
+                 grouping_cache_bytes=None, fused_grouping=True,
+                 split_transfer=True, checkpoint_stages=None, **kwargs):
+        """
+        :param checkpoint_stages: stages whose LocalGrouper + PreExtraction activations are recomputed in
+            backward instead of stored, True for all of them, None for none
+        """
         super(Model, self).__init__()
         self.stages = len(pre_blocks)
+        self.checkpoint_stages = set(range(self.stages) if checkpoint_stages is True else checkpoint_stages or [])
         self.class_num = class_num
         self.points = points
         self.embedding = ConvBNReLU1D(3, embed_dim, bias=bias, activation=activation)
         assert len(pre_blocks) == len(k_neighbors) == len(reducers) == len(pos_blocks) == len(dim_expansion), \
             "Please check stage number consistent for pre_blocks, pos_blocks k_neighbors, reducers."
+        # opt-in cache of the fps/knn indices for callers that see the same clouds again, e.g. the
+        # validation of every epoch, it hashes every cloud on the host; None or 0 disables the cache
+        self.grouping_cache = GroupingCache(grouping_cache_bytes) if grouping_cache_bytes else None
         self.local_grouper_list = nn.ModuleList()
         self.pre_blocks_list = nn.ModuleList()
         self.pos_blocks_list = nn.ModuleList()
@@ -302,12 +855,16 @@ class Model(nn.Module):
             reduce = reducers[i]
             anchor_points = anchor_points // reduce
             # append local_grouper_list
-            local_grouper = LocalGrouper(last_channel, anchor_points, kneighbor, use_xyz, normalize)  # [b,g,k,d]
+            local_grouper = LocalGrouper(last_channel, anchor_points, kneighbor, use_xyz, normalize,
+                                         knn_max_elements=knn_max_elements, knn_index=knn_index,
+                                         cache=self.grouping_cache, fused=fused_grouping,
+                                         concat_anchor=not split_transfer)  # [b,g,k,d]
             self.local_grouper_list.append(local_grouper)
             # append pre_block_list
             pre_block_module = PreExtraction(last_channel, out_channel, pre_block_num, groups=groups,
                                              res_expansion=res_expansion,
-                                             bias=bias, activation=activation, use_xyz=use_xyz)
+                                             bias=bias, activation=activation, use_xyz=use_xyz,
+                                             split_transfer=split_transfer)
             self.pre_blocks_list.append(pre_block_module)
             # append pos_block_list
             pos_block_module = PosExtraction(out_channel, pos_block_num, groups=groups,
@@ -335,15 +892,66 @@ class Model(nn.Module):
         x = self.embedding(x)  # B,D,N
         for i in range(self.stages):
             # Give xyz[b, p, 3] and fea[b, p, d], return new_xyz[b, g, 3] and new_fea[b, g, k, d]
-            xyz, x = self.local_grouper_list[i](xyz, x.permute(0, 2, 1))  # [b,g,3]  [b,g,k,d]
-            x = self.pre_blocks_list[i](x)  # [b,d,g]
+            if i in self.checkpoint_stages and self.training and torch.is_grad_enabled():
+                xyz, x = checkpoint_stage(self.local_grouper_list[i], self.pre_blocks_list[i],
+                                          xyz, x.permute(0, 2, 1))  # [b,g,3]  [b,d,g]
+            else:
+                xyz, x = self.local_grouper_list[i](xyz, x.permute(0, 2, 1))  # [b,g,3]  [b,g,k,d]
+                x = self.pre_blocks_list[i](x)  # [b,d,g]
             x = self.pos_blocks_list[i](x)  # [b,d,g]
 
         x = F.adaptive_max_pool1d(x, 1).squeeze(dim=-1)
         x = self.classifier(x)
         return x
 
-
+    def fuse_for_inference(self, *inputs, atol=1e-4):
+        """
+        Returns a frozen copy of the model in eval mode with every BatchNorm folded into the preceding
+        Conv1d/Linear, after checking it against this model on inputs (random clouds when not given).
+        """
+        model = fuse_bn_layers(copy.deepcopy(self).eval())
+        for param in model.parameters():
+            param.requires_grad_(False)
+        if len(inputs) == 0:
+            inputs = [torch.rand(2, 3, self.points, device=next(self.parameters()).device)]
+        training = self.training
+        self.eval()
+        with torch.no_grad():
+            expected, output = self(*inputs), model(*inputs)
+        self.train(training)
+        error = (expected - output).abs().max().item()
+        assert error <= atol * max(1., expected.abs().max().item()), \
+            f"Fused model differs from the original one by {error}, please check the BatchNorm folding."
+        return model
+
+
+def compile_model(model, *inputs, fused_grouping=False, atol=1e-4, **kwargs):
+    """
+    Returns the inference copy of model (see fuse_for_inference) compiled by torch.compile as a single graph,
+    checked against the uncompiled copy on inputs (random clouds when not given). The grouping cache, which
+    hashes the clouds on the host, is disabled and the groups are normalized by plain torch ops, which the
+    compiler fuses with the neighbouring elementwise ops, unless fused_grouping.
+    :param kwargs: arguments of torch.compile, fullgraph=True by default
+    """
+    assert hasattr(torch, "compile") and hasattr(torch.library, "custom_op"), \
+        "compile_model needs torch>=2.4 to keep the FPS of pointnet2_ops in the graph."
+    assert all(grouper.knn_index is None for grouper in model.local_grouper_list), \
+        "The MortonIndex kNN search breaks the full-graph compilation, please compile a model with knn_index=None."
+    if len(inputs) == 0:
+        inputs = [torch.rand(2, 3, model.points, device=next(model.parameters()).device)]
+    model = model.fuse_for_inference(*inputs, atol=atol)
+    model.grouping_cache = None
+    for grouper in model.local_grouper_list:
+        grouper.cache = None
+        grouper.fused = fused_grouping
+    kwargs.setdefault("fullgraph", True)
+    compiled = torch.compile(model, **kwargs)
+    with torch.no_grad():
+        expected, output = model(*inputs), compiled(*inputs)  # the first call compiles
+    error = (expected - output).abs().max().item()
+    assert error <= atol * max(1., expected.abs().max().item()), \
+        f"Compiled model differs from the eager one by {error}."
+    return compiled
 
 
 def pointMLP(num_classes=40, **kwargs) -> Model:
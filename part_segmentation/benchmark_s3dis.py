@@ -0,0 +1,88 @@
+"""
+Samples/second of one S3DISDataset worker, full-room search per block (before) vs grid index (after).
+python benchmark_s3dis.py --data_root data/stanford_indoor3d/
+Without --data_root, synthetic rooms are generated in a temporary directory.
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from util.S3DISDataLoader import S3DISDataset
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('S3DIS block sampling benchmark')
+    parser.add_argument('--data_root', type=str, default=None, help='directory of the Area_*.npy rooms')
+    parser.add_argument('--num_point', type=int, default=4096, help='points per block')
+    parser.add_argument('--samples', type=int, default=200, help='blocks sampled per method')
+    parser.add_argument('--rooms', type=int, default=4, help='number of synthetic rooms')
+    parser.add_argument('--room_points', type=int, default=1000000, help='points per synthetic room')
+    return parser.parse_args()
+
+
+def synthetic_rooms(path, rooms, room_points):
+    # floor, ceiling and walls of 6m x 8m x 3m rooms with a few dense clusters, xyzrgbl
+    for i in range(rooms):
+        xyz = np.random.rand(room_points, 3) * [6., 8., 3.]
+        wall = np.random.rand(room_points) < 0.5
+        xyz[wall, np.random.randint(0, 2, wall.sum())] = 0.
+        clusters = np.random.rand(10, 3) * [6., 8., 3.]
+        dense = np.random.rand(room_points) < 0.3
+        xyz[dense] = clusters[np.random.randint(0, 10, dense.sum())] + 0.2 * np.random.randn(dense.sum(), 3)
+        rgb = np.random.rand(room_points, 3) * 255.
+        label = np.random.randint(0, 13, (room_points, 1))
+        np.save(os.path.join(path, 'Area_1_room_%d.npy' % i), np.concatenate([xyz, rgb, label], axis=1))
+
+
+def full_room_block(dataset, room_idx):
+    # the former sampling: random centers, each tested with a search over the whole room
+    points = dataset.room_points[room_idx]
+    while (True):
+        center = points[np.random.choice(points.shape[0])][:3]
+        block_min = center - [dataset.block_size / 2.0, dataset.block_size / 2.0, 0]
+        block_max = center + [dataset.block_size / 2.0, dataset.block_size / 2.0, 0]
+        point_idxs = np.where((points[:, 0] >= block_min[0]) & (points[:, 0] <= block_max[0]) & (points[:, 1] >= block_min[1]) & (points[:, 1] <= block_max[1]))[0]
+        if point_idxs.size > 1024:
+            return point_idxs
+
+
+def grid_block(dataset, room_idx):
+    points = dataset.room_points[room_idx]
+    while (True):
+        center = points[np.random.choice(dataset.room_centers[room_idx])][:3]
+        block_min = center - [dataset.block_size / 2.0, dataset.block_size / 2.0, 0]
+        block_max = center + [dataset.block_size / 2.0, dataset.block_size / 2.0, 0]
+        point_idxs = dataset.query_block(room_idx, block_min, block_max)
+        if point_idxs.size > dataset.min_block_points:
+            return point_idxs
+
+
+def main():
+    args = parse_args()
+    np.random.seed(0)
+    tmp = None
+    if args.data_root is None:
+        tmp = tempfile.TemporaryDirectory()
+        synthetic_rooms(tmp.name, args.rooms, args.room_points)
+        args.data_root = tmp.name
+    start = time.time()
+    dataset = S3DISDataset(split='train', data_root=args.data_root, num_point=args.num_point, test_area=5)
+    print('dataset built in %.1fs' % (time.time() - start))
+    room_idxs = dataset.room_idxs[np.random.randint(0, len(dataset), args.samples)]
+
+    for name, block in [('full room', full_room_block), ('grid index', grid_block)]:
+        start = time.time()
+        for room_idx in room_idxs:
+            block(dataset, room_idx)
+        print('%-12s blocks: %8.1f samples/s' % (name, args.samples / (time.time() - start)))
+    start = time.time()
+    for i in np.random.randint(0, len(dataset), args.samples):
+        dataset[i]
+    print('%-12s items:  %8.1f samples/s' % ('__getitem__', args.samples / (time.time() - start)))
+    if tmp is not None:
+        tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,10 @@ import torch.nn as nn
 import model as models
 import numpy as np
 from torch.utils.data import DataLoader,SubsetRandomSampler,Subset
-from util.util import to_categorical, compute_overall_iou, IOStream
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
+from util.util import to_categorical, compute_shape_ious, IOStream, PRECISIONS, get_autocast, get_grad_scaler, \
+    init_distributed, is_main_process, shard_indices, all_reduce_sum
 from tqdm import tqdm
 from collections import defaultdict
 from torch.autograd import Variable
@@ -54,13 +57,21 @@ def train(args, io):
 
     # ============= Model ===================
     num_part = 13
-    device = torch.device("cuda" if args.cuda else "cpu")
+    device = torch.device(("cuda:%d" % args.local_rank if args.ddp else "cuda") if args.cuda else "cpu")
 
-    model = models.__dict__[args.model](num_part).to(device)
+    model = models.__dict__[args.model](num_part,
+                                        checkpoint_stages=True if args.checkpoint_stages == [] else args.checkpoint_stages,
+                                        checkpoint_decoder=args.checkpoint_decoder).to(device)
     #io.cprint(str(model))
 
     model.apply(weight_init)
-    model = nn.DataParallel(model)
+    if args.ddp:
+        if args.sync_bn:
+            model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+        # one process per device, the gradients are averaged by all-reduce during backward
+        model = DistributedDataParallel(model, device_ids=[args.local_rank] if args.cuda else None)
+    else:
+        model = nn.DataParallel(model)
     print(f"Model size: {sum(p.numel() for p in model.parameters() if p.requires_grad)}")
     print("Let's use", torch.cuda.device_count(), "GPUs!")
 
@@ -105,9 +116,9 @@ def train(args, io):
     NUM_POINT = 2048
 
     print("start loading training data ...")
-    train_data = S3DISDataset(split='train', data_root=root, num_point=NUM_POINT)
+    train_data = S3DISDataset(split='train', data_root=root, num_point=NUM_POINT, mmap=args.mmap)
     print("start loading test data ...")
-    test_data= S3DISDataset(split='test', data_root=root, num_point=NUM_POINT )
+    test_data= S3DISDataset(split='test', data_root=root, num_point=NUM_POINT, mmap=args.mmap)
 
     # num_samples = 800  # Specify the number of samples you want
     # sampler = SubsetRandomSampler(range(num_samples))
@@ -127,10 +138,15 @@ def train(args, io):
     # Now flattened_data is a single list containing the first 320 elements
 
     
+    train_sampler = None
+    if args.ddp:
+        # --batch_size stays the global batch, split over the ranks
+        args.batch_size = args.batch_size // args.world_size
+        train_sampler = DistributedSampler(train_data, shuffle=False, drop_last=True)
     train_loader = DataLoader(train_data, batch_size=args.batch_size, shuffle=False, num_workers=args.workers,
-                              drop_last=True)
+                              sampler=train_sampler, drop_last=True)
     test_loader = DataLoader(test_data, batch_size=args.test_batch_size, shuffle=False, num_workers=args.workers,
-                             drop_last=False)
+                             sampler=shard_indices(len(test_data)) if args.ddp else None, drop_last=False)
 
 
     # ============= Optimizer ================
@@ -157,18 +173,25 @@ def train(args, io):
     num_part = 13
     num_classes = 13
 
+    scaler = get_grad_scaler(device, args.precision)
     for epoch in range(args.epochs):
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
 
-        train_epoch(train_loader, model, opt, scheduler, epoch, num_part, num_classes, io)
+        train_epoch(train_loader, model, opt, scheduler, epoch, num_part, num_classes, io, args.precision, scaler, device)
 
-        test_metrics, total_per_cat_iou = test_epoch(test_loader, model, epoch, num_part, num_classes, io)
+        # the shards of the test set differ in size, the forward passes must not wait for each other
+        test_metrics, total_per_cat_iou = test_epoch(test_loader, model.module if args.ddp else model, epoch, num_part,
+                                                     num_classes, io, args.precision, device)
+        if not is_main_process():
+            continue
 
         # 1. when get the best accuracy, save the model:
         if test_metrics['accuracy'] > best_acc:
             best_acc = test_metrics['accuracy']
             io.cprint('Max Acc:%.5f' % best_acc)
             state = {
-                'model': model.module.state_dict() if torch.cuda.device_count() > 1 else model.state_dict(),
+                'model': model.module.state_dict() if args.ddp or torch.cuda.device_count() > 1 else model.state_dict(),
                 'optimizer': opt.state_dict(), 'epoch': epoch, 'test_acc': best_acc}
             torch.save(state, 'checkpoints/%s/best_acc_model.pth' % args.exp_name)
 
@@ -177,7 +200,7 @@ def train(args, io):
             best_instance_iou = test_metrics['shape_avg_iou']
             io.cprint('Max instance iou:%.5f' % best_instance_iou)
             state = {
-                'model': model.module.state_dict() if torch.cuda.device_count() > 1 else model.state_dict(),
+                'model': model.module.state_dict() if args.ddp or torch.cuda.device_count() > 1 else model.state_dict(),
                 'optimizer': opt.state_dict(), 'epoch': epoch, 'test_instance_iou': best_instance_iou}
             torch.save(state, 'checkpoints/%s/best_insiou_model.pth' % args.exp_name)
 
@@ -194,7 +217,7 @@ def train(args, io):
                 io.cprint(classes_str[cat_idx] + ' iou: ' + str(total_per_cat_iou[cat_idx]))
             io.cprint('Max class iou:%.5f' % best_class_iou)
             state = {
-                'model': model.module.state_dict() if torch.cuda.device_count() > 1 else model.state_dict(),
+                'model': model.module.state_dict() if args.ddp or torch.cuda.device_count() > 1 else model.state_dict(),
                 'optimizer': opt.state_dict(), 'epoch': epoch, 'test_class_iou': best_class_iou}
             torch.save(state, 'checkpoints/%s/best_clsiou_model.pth' % args.exp_name)
 
@@ -203,19 +226,23 @@ def train(args, io):
     io.cprint('Final Max instance iou:%.5f' % best_instance_iou)
     io.cprint('Final Max class iou:%.5f' % best_class_iou)
     # save last model
+    if not is_main_process():
+        return
     state = {
-        'model': model.module.state_dict() if torch.cuda.device_count() > 1 else model.state_dict(),
+        'model': model.module.state_dict() if args.ddp or torch.cuda.device_count() > 1 else model.state_dict(),
         'optimizer': opt.state_dict(), 'epoch': args.epochs - 1, 'test_iou': best_instance_iou}
     torch.save(state, 'checkpoints/%s/model_ep%d.pth' % (args.exp_name, args.epochs))
 
 
-def train_epoch(train_loader, model, opt, scheduler, epoch, num_part, num_classes, io):
+def train_epoch(train_loader, model, opt, scheduler, epoch, num_part, num_classes, io, precision='fp32', scaler=None,
+                device='cuda'):
     train_loss = 0.0
     count = 0.0
     accuracy = []
     shape_ious = 0.0
     metrics = defaultdict(lambda: list())
     model.train()
+    scaler = get_grad_scaler(device, precision) if scaler is None else scaler
     #print("LENGTH TRAIN HERE:", len(train_loader))
 
     for batch_id, (points, target, normal, color) in tqdm(enumerate(train_loader), total=len(train_loader), smoothing=0.9):
@@ -229,7 +256,7 @@ def train_epoch(train_loader, model, opt, scheduler, epoch, num_part, num_classe
         points = points.transpose(2, 1)
         norm_plt = norm_plt.transpose(2, 1)
         color = color.transpose(2, 1)
-        points, target, norm_plt, color = points.cuda(non_blocking=True), target.cuda(non_blocking=True), norm_plt.cuda(non_blocking=True), color.cuda(non_blocking=True)
+        points, target, norm_plt, color = points.to(device, non_blocking=True), target.to(device, non_blocking=True), norm_plt.to(device, non_blocking=True), color.to(device, non_blocking=True)
         
         # target: b,n
         # print( "SHAPE INFOS: \n")
@@ -239,21 +266,21 @@ def train_epoch(train_loader, model, opt, scheduler, epoch, num_part, num_classe
         # print( "SHAPE NORM_PLT: ", norm_plt.shape)
 
         #seg_pred = model(points, norm_plt, to_categorical(label, num_classes))  # seg_pred: b,n,50
-        seg_pred = model(points, norm_plt, color)  # seg_pred: b,n,50
-        #print( "SHAPE SEG PREDICTION: ", seg_pred.shape)
-        num_part = 13
-        loss = F.nll_loss(seg_pred.contiguous().view(-1, num_part), target.view(-1, 1)[:, 0])
+        with get_autocast(device, precision):
+            seg_pred = model(points, norm_plt, color)  # seg_pred: b,n,50
+            #print( "SHAPE SEG PREDICTION: ", seg_pred.shape)
+            num_part = 13
+            loss = F.nll_loss(seg_pred.contiguous().view(-1, num_part), target.view(-1, 1)[:, 0])
 
         # instance iou without considering the class average at each batch_size:
-        batch_shapeious = compute_overall_iou(seg_pred, target, num_part)  # list of of current batch_iou:[iou1,iou2,...,iou#b_size]
-        # total iou of current batch in each process:
-        batch_shapeious = seg_pred.new_tensor([np.sum(batch_shapeious)], dtype=torch.float64)  # same device with seg_pred!!!
+        batch_shapeious, _ = compute_shape_ious(seg_pred.detach(), target, num_part)  # [b], same device with seg_pred
 
         # Loss backward
         loss = torch.mean(loss)
         opt.zero_grad()
-        loss.backward()
-        opt.step()
+        scaler.scale(loss).backward()
+        scaler.step(opt)
+        scaler.update()
 
         # accuracy
         seg_pred = seg_pred.contiguous().view(-1, num_part)  # b*n,50
@@ -261,11 +288,11 @@ def train_epoch(train_loader, model, opt, scheduler, epoch, num_part, num_classe
         pred_choice = seg_pred.contiguous().data.max(1)[1]  # b*n
         correct = pred_choice.eq(target.contiguous().data).sum()  # torch.int64: total number of correct-predict pts
 
-        # sum
-        shape_ious += batch_shapeious.item()  # count the sum of ious in each iteration
+        # sum, kept on the device and only synchronized at the end of the epoch
+        shape_ious += batch_shapeious.sum()  # count the sum of ious in each iteration
         count += batch_size   # count the total number of samples in each iteration
-        train_loss += loss.item() * batch_size
-        accuracy.append(correct.item()/(batch_size * num_point))   # append the accuracy of each iteration
+        train_loss += loss.detach().double() * batch_size
+        accuracy.append(correct.double() / (batch_size * num_point))   # append the accuracy of each iteration
 
         # Note: We do not need to calculate per_class iou during training
 
@@ -279,7 +306,11 @@ def train_epoch(train_loader, model, opt, scheduler, epoch, num_part, num_classe
                 param_group['lr'] = 0.9e-5
     io.cprint('Learning rate: %f' % opt.param_groups[0]['lr'])
 
-    metrics['accuracy'] = np.mean(accuracy)
+    # sums of the epoch, over all ranks with --ddp
+    sums = torch.stack([torch.as_tensor(x, dtype=torch.float64, device=device) for x in
+                        [shape_ious, count, train_loss, torch.stack(accuracy).sum(), len(accuracy)]])
+    shape_ious, count, train_loss, accuracy, batches = all_reduce_sum(sums)[0].tolist()
+    metrics['accuracy'] = accuracy / batches
     metrics['shape_avg_iou'] = shape_ious * 1.0 / count
 
     outstr = 'Train %d, loss: %f, train acc: %f, train ins_iou: %f' % (epoch+1, train_loss * 1.0 / count,
@@ -287,13 +318,13 @@ def train_epoch(train_loader, model, opt, scheduler, epoch, num_part, num_classe
     io.cprint(outstr)
 
 
-def test_epoch(test_loader, model, epoch, num_part, num_classes, io):
+def test_epoch(test_loader, model, epoch, num_part, num_classes, io, precision='fp32', device='cuda'):
     test_loss = 0.0
     count = 0.0
     accuracy = []
     shape_ious = 0.0
-    final_total_per_cat_iou = np.zeros(13).astype(np.float32)
-    final_total_per_cat_seen = np.zeros(13).astype(np.int32)
+    final_total_per_cat_iou = torch.zeros(13, dtype=torch.float64, device=device)
+    final_total_per_cat_seen = torch.zeros(13, dtype=torch.int64, device=device)
     metrics = defaultdict(lambda: list())
     model.eval()
 
@@ -307,29 +338,15 @@ def test_epoch(test_loader, model, epoch, num_part, num_classes, io):
         points = points.transpose(2, 1)
         norm_plt = norm_plt.transpose(2, 1)
         color = color.transpose(2, 1)
-        points, target, norm_plt, color = points.cuda(non_blocking=True), target.cuda(non_blocking=True), norm_plt.cuda(non_blocking=True), color.cuda(non_blocking=True)
-        seg_pred = model(points, norm_plt, color)  # b,n,50
+        points, target, norm_plt, color = points.to(device, non_blocking=True), target.to(device, non_blocking=True), norm_plt.to(device, non_blocking=True), color.to(device, non_blocking=True)
+        with get_autocast(device, precision):
+            seg_pred = model(points, norm_plt, color)  # b,n,50
 
         # instance iou without considering the class average at each batch_size:
-        batch_shapeious = compute_overall_iou(seg_pred, target, num_part)  # [b]
-        # per category iou at each batch_size:
-        # print( "predıcted value HEREE : ", len(batch_shapeious)) #32
-        # print( "predıcted value HEREE222 : ", seg_pred.size(0)) #32
-        # # print( "predıcted value HEREE3333 : ", seg_pred.shape) #32,2048,13
-        # # print( "predıcted value HEREE4444 : ", target[0][0]) #32,2048
-        # print("HWAT IS TAARGETTTT", target.shape)
-
-        # print('for loop seg pred size: ',seg_pred.size(0))
-        for shape_idx in range(seg_pred.size(0)):  # sample_idx
-           # cur_gt_label = label[shape_idx]  # label[sample_idx], denotes current sample belongs to which cat
-            cur_gt_label = target[shape_idx]
-            # final_total_per_cat_iou[cur_gt_label] += batch_shapeious[shape_idx]  # add the iou belongs to this cat
-            cur_gt_label_cpu = cur_gt_label.cpu().numpy()
-            final_total_per_cat_iou[cur_gt_label_cpu] += batch_shapeious[shape_idx]
-            final_total_per_cat_seen[cur_gt_label_cpu] += 1  # count the number of this cat is chosen
-
-        # total iou of current batch in each process:
-        batch_ious = seg_pred.new_tensor([np.sum(batch_shapeious)], dtype=torch.float64)  # same device with seg_pred!!!
+        batch_shapeious, present = compute_shape_ious(seg_pred, target, num_part)  # [b], [b, 13]
+        # per category iou at each batch_size, every shape counts once for each category in its target:
+        final_total_per_cat_iou += (present * batch_shapeious.view(-1, 1)).sum(dim=0)
+        final_total_per_cat_seen += present.sum(dim=0)
 
         # prepare seg_pred and target for later calculating loss and acc:
         seg_pred = seg_pred.contiguous().view(-1, num_part)
@@ -347,16 +364,23 @@ def test_epoch(test_loader, model, epoch, num_part, num_classes, io):
 
 
         loss = torch.mean(loss)
-        shape_ious += batch_ious.item()  # count the sum of ious in each iteration
+        shape_ious += batch_shapeious.sum()  # count the sum of ious in each iteration
         count += batch_size  # count the total number of samples in each iteration
-        test_loss += loss.item() * batch_size
-        accuracy.append(correct.item() / (batch_size * num_point))  # append the accuracy of each iteration
-
+        test_loss += loss.detach().double() * batch_size
+        accuracy.append(correct.double() / (batch_size * num_point))  # append the accuracy of each iteration
+
+    # a single synchronization with the device per epoch, the sums cover all ranks with --ddp
+    sums = torch.stack([torch.as_tensor(x, dtype=torch.float64, device=device) for x in
+                        [shape_ious, count, test_loss, torch.stack(accuracy).sum(), len(accuracy)]])
+    all_reduce_sum(sums, final_total_per_cat_iou, final_total_per_cat_seen)
+    shape_ious, count, test_loss, accuracy, batches = sums.tolist()
+    final_total_per_cat_iou = final_total_per_cat_iou.cpu().numpy().astype(np.float32)
+    final_total_per_cat_seen = final_total_per_cat_seen.cpu().numpy().astype(np.int32)
     for cat_idx in range(13):
         if final_total_per_cat_seen[cat_idx] > 0:  # indicating this cat is included during previous iou appending
             final_total_per_cat_iou[cat_idx] = final_total_per_cat_iou[cat_idx] / final_total_per_cat_seen[cat_idx]  # avg class iou across all samples
 
-    metrics['accuracy'] = np.mean(accuracy)
+    metrics['accuracy'] = accuracy / batches
     metrics['shape_avg_iou'] = shape_ious * 1.0 / count
 
     outstr = 'Test %d, loss: %f, test acc: %f  test ins_iou: %f' % (epoch + 1, test_loss * 1.0 / count,
@@ -377,7 +401,7 @@ def test(args, io):
     NUM_CLASSES = 13
     NUM_POINT = 2048
 
-    test_data= S3DISDataset(split='test', data_root=root, num_point=NUM_POINT )
+    test_data= S3DISDataset(split='test', data_root=root, num_point=NUM_POINT, mmap=args.mmap)
 
     test_loader = DataLoader(test_data, batch_size=args.test_batch_size, shuffle=False, num_workers=args.workers,
                              drop_last=False)
@@ -420,23 +444,13 @@ def test(args, io):
             seg_pred = model(points, norm_plt)  # b,n,50
 
         # instance iou without considering the class average at each batch_size:
-        batch_shapeious = compute_overall_iou(seg_pred, target, num_part)  # [b]
-        shape_ious += batch_shapeious  # iou +=, equals to .append
-
-        # # per category iou at each batch_size:
-        # for shape_idx in range(seg_pred.size(0)):  # sample_idx
-        #     cur_gt_label = label[shape_idx]  # label[sample_idx]
-        #     total_per_cat_iou[cur_gt_label] += batch_shapeious[shape_idx]
-        #     total_per_cat_seen[cur_gt_label] += 1
-
-        for shape_idx in range(seg_pred.size(0)):  # sample_idx
-            # cur_gt_label = label[shape_idx]  # label[sample_idx], denotes current sample belongs to which cat
-            cur_gt_label = target[shape_idx]
-            # final_total_per_cat_iou[cur_gt_label] += batch_shapeious[shape_idx]  # add the iou belongs to this cat
-            cur_gt_label_cpu = cur_gt_label.cpu().numpy()
-            total_per_cat_iou[cur_gt_label_cpu] += batch_shapeious[shape_idx]
-            total_per_cat_seen[cur_gt_label_cpu] += 1  # count the number of this cat is chosen
+        batch_shapeious, present = compute_shape_ious(seg_pred, target, num_part)  # [b], [b, 13]
+        shape_ious += batch_shapeious.tolist()  # iou +=, equals to .append
 
+        # per category iou at each batch_size, every shape counts once for each category in its target:
+        present = present.cpu().numpy()
+        total_per_cat_iou += (present * batch_shapeious.cpu().numpy()[:, None]).sum(axis=0).astype(np.float32)
+        total_per_cat_seen += present.sum(axis=0).astype(np.int32)
 
         # accuracy:
         seg_pred = seg_pred.contiguous().view(-1, num_part)
@@ -493,6 +507,19 @@ if __name__ == "__main__":
     parser.add_argument('--num_points', type=int, default=2048,
                         help='num of points to use')
     parser.add_argument('--workers', type=int, default=12)
+    parser.add_argument('--mmap', action='store_true', default=False,
+                        help='serve the rooms from a memory-mapped store shared by the workers')
+    parser.add_argument('--precision', type=str, default='fp32', choices=list(PRECISIONS),
+                        help='autocast precision of the forward pass, fp16 also scales the loss')
+    parser.add_argument('--checkpoint_stages', type=int, nargs='*', default=None,
+                        help='recompute the grouping of these encoder stages in backward to save memory, '
+                             'e.g. --checkpoint_stages 0 1; a bare --checkpoint_stages means all stages')
+    parser.add_argument('--checkpoint_decoder', action='store_true', default=False,
+                        help='recompute the feature propagation blocks of the decoder in backward as well')
+    parser.add_argument('--ddp', action='store_true', default=False,
+                        help='DistributedDataParallel training, launch with torchrun --nproc_per_node=N main.py --ddp')
+    parser.add_argument('--sync_bn', action='store_true', default=False,
+                        help='SyncBatchNorm across the ranks with --ddp')
     parser.add_argument('--resume', type=bool, default=False,
                         help='Resume training or not')
     parser.add_argument('--model_type', type=str, default='insiou',
@@ -500,8 +527,10 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     args.exp_name = args.model+"_"+args.exp_name
+    args.rank, args.world_size, args.local_rank = init_distributed() if args.ddp else (0, 1, 0)
 
-    _init_()
+    if is_main_process():
+        _init_()
 
     if not args.eval:
         io = IOStream('checkpoints/' + args.exp_name + '/%s_train.log' % (args.exp_name))
@@ -510,8 +539,9 @@ if __name__ == "__main__":
     io.cprint(str(args))
 
     if args.manual_seed is not None:
-        random.seed(args.manual_seed)
-        np.random.seed(args.manual_seed)
+        # the blocks are sampled with numpy, the ranks must not draw the same ones
+        random.seed(args.manual_seed + args.rank)
+        np.random.seed(args.manual_seed + args.rank)
         torch.manual_seed(args.manual_seed)
 
     args.cuda = not args.no_cuda and torch.cuda.is_available()
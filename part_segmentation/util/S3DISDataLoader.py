@@ -1,16 +1,119 @@
 import os
+import shutil
 import numpy as np
 
 from tqdm import tqdm
 from torch.utils.data import Dataset
 
 
+def grid_index(xy, coord_min, cell_size):
+    """
+    Input:
+        xy: point coordinates in the plane, [N, 2]
+        coord_min: lower corner of the grid, [2]
+        cell_size: side of the square cells
+    Return:
+        order: permutation sorting the points by cell, [N]
+        offsets: after sorting, the points of cell (x, y) are [offsets[x * ny + y], offsets[x * ny + y + 1]), [nx * ny + 1]
+        shape: (nx, ny)
+    """
+    cells = np.floor((xy - coord_min) / cell_size).astype(np.int64)
+    nx, ny = cells.max(axis=0) + 1
+    keys = cells[:, 0] * ny + cells[:, 1]
+    order = np.argsort(keys, kind='stable')
+    offsets = np.zeros(nx * ny + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=nx * ny), out=offsets[1:])
+    return order, offsets, (int(nx), int(ny))
+
+
+def window_sum(counts, radius):
+    # sum of counts over the (2 * radius + 1) ** 2 cells around every cell
+    table = np.pad(np.pad(counts, radius).cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    size = 2 * radius + 1
+    return table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size]
+
+
+STORE_ARRAYS = ['points', 'labels', 'room_offsets', 'grid_offsets', 'grid_starts', 'grid_shape', 'coord_min',
+                'coord_max', 'centers', 'center_starts', 'label_hist']
+
+
+def build_room_store(data_root, rooms, cell_size, window, min_block_points, path=None):
+    """
+    Concatenates the rooms, each sorted by the cells of its grid index, into flat arrays with offset tables.
+    With path, the point and label arrays are written straight into .npy files there instead of memory.
+    Return:
+        dict of STORE_ARRAYS, room r is points[room_offsets[r]:room_offsets[r + 1]], its grid offsets are
+        grid_offsets[grid_starts[r]:grid_starts[r + 1]] and its centers centers[center_starts[r]:center_starts[r + 1]]
+    """
+    # the shapes are read from the headers only, the rooms are then loaded one by one
+    shapes = [np.load(os.path.join(data_root, room), mmap_mode='r').shape for room in rooms]
+    room_offsets = np.cumsum([0] + [shape[0] for shape in shapes])
+    total = int(room_offsets[-1])
+    dtype = np.load(os.path.join(data_root, rooms[0]), mmap_mode='r').dtype
+    if path is None:
+        points, labels = np.empty((total, 6), dtype), np.empty(total, dtype)
+    else:
+        points = np.lib.format.open_memmap(os.path.join(path, 'points.npy'), 'w+', dtype, (total, 6))
+        labels = np.lib.format.open_memmap(os.path.join(path, 'labels.npy'), 'w+', dtype, (total,))
+    grid_offsets, grid_shape, coord_min_all, coord_max_all, centers = [], [], [], [], []
+    label_hist = np.zeros(13)
+    for i, room_name in enumerate(tqdm(rooms, total=len(rooms))):
+        room_data = np.load(os.path.join(data_root, room_name))  # xyzrgbl, N*7
+        room_points, room_labels = room_data[:, 0:6], room_data[:, 6]  # xyzrgb, N*6; l, N
+        tmp, _ = np.histogram(room_labels, range(14))
+        label_hist += tmp
+        coord_min, coord_max = np.amin(room_points, axis=0)[:3], np.amax(room_points, axis=0)[:3]
+        order, offsets, shape = grid_index(room_points[:, :2], coord_min[:2], cell_size)
+        points[room_offsets[i]:room_offsets[i + 1]] = room_points[order]
+        labels[room_offsets[i]:room_offsets[i + 1]] = room_labels[order]
+        # only centers in cells whose neighbourhood holds enough points can give a valid block
+        counts = np.diff(offsets)
+        candidates = window_sum(counts.reshape(shape), window).ravel() > min_block_points
+        centers.append(np.nonzero(np.repeat(candidates, counts))[0])
+        grid_offsets.append(offsets), grid_shape.append(shape)
+        coord_min_all.append(coord_min), coord_max_all.append(coord_max)
+    store = {
+        'points': points, 'labels': labels, 'room_offsets': room_offsets,
+        'grid_offsets': np.concatenate(grid_offsets), 'grid_starts': np.cumsum([0] + [len(o) for o in grid_offsets]),
+        'grid_shape': np.array(grid_shape, dtype=np.int64).reshape(-1, 2),
+        'coord_min': np.array(coord_min_all).reshape(-1, 3), 'coord_max': np.array(coord_max_all).reshape(-1, 3),
+        'centers': np.concatenate(centers), 'center_starts': np.cumsum([0] + [len(c) for c in centers]),
+        'label_hist': label_hist,
+    }
+    if path is not None:
+        points.flush(), labels.flush()
+        for name in STORE_ARRAYS[2:]:
+            np.save(os.path.join(path, name + '.npy'), store[name])
+    return store
+
+
+def load_room_store(data_root, rooms, cell_size, window, min_block_points, path):
+    """
+    Memory-mapped room store at path, built by build_room_store on first use. The pages of the mapping are
+    shared by all DataLoader workers and only read from disk when a block touches them.
+    """
+    if not os.path.isdir(path):
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        os.makedirs(tmp_path)
+        build_room_store(data_root, rooms, cell_size, window, min_block_points, tmp_path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:  # built by a concurrent run in the meantime
+            shutil.rmtree(tmp_path)
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in STORE_ARRAYS}
+
+
 class S3DISDataset(Dataset):
-    def __init__(self, split='train', data_root='trainval_fullarea', num_point=4096, test_area=5, block_size=1.0, sample_rate=1.0, transform=None):
+    def __init__(self, split='train', data_root='trainval_fullarea', num_point=4096, test_area=5, block_size=1.0, sample_rate=1.0, transform=None,
+                 min_block_points=1024, cells_per_block=4, mmap=False):
         super().__init__()
         self.num_point = num_point
         self.block_size = block_size
         self.transform = transform
+        self.min_block_points = min_block_points
+        # every room is indexed by a 2D grid, blocks are gathered from the cells they overlap
+        self.cell_size = block_size / cells_per_block
+        self.window = cells_per_block // 2 + 1  # cells around a center that its block can reach
         rooms = sorted(os.listdir(data_root))
         rooms = [room for room in rooms if 'Area_' in room]
         if split == 'train':
@@ -18,21 +121,23 @@ class S3DISDataset(Dataset):
         else:
             rooms_split = [room for room in rooms if 'Area_{}'.format(test_area) in room]
 
-        self.room_points, self.room_labels = [], []
-        self.room_coord_min, self.room_coord_max = [], []
-        num_point_all = []
-        labelweights = np.zeros(13)
-
-        for room_name in tqdm(rooms_split, total=len(rooms_split)):
-            room_path = os.path.join(data_root, room_name)
-            room_data = np.load(room_path)  # xyzrgbl, N*7
-            points, labels = room_data[:, 0:6], room_data[:, 6]  # xyzrgb, N*6; l, N
-            tmp, _ = np.histogram(labels, range(14))
-            labelweights += tmp
-            coord_min, coord_max = np.amin(points, axis=0)[:3], np.amax(points, axis=0)[:3]
-            self.room_points.append(points), self.room_labels.append(labels)
-            self.room_coord_min.append(coord_min), self.room_coord_max.append(coord_max)
-            num_point_all.append(labels.size)
+        if mmap:
+            # one flat memory-mapped copy of the split, the rooms are views of it
+            path = os.path.join(data_root, 'room_store_{}_{}_{}_{}_{}'.format(
+                split, test_area, block_size, cells_per_block, min_block_points))
+            store = load_room_store(data_root, rooms_split, self.cell_size, self.window, min_block_points, path)
+        else:
+            store = build_room_store(data_root, rooms_split, self.cell_size, self.window, min_block_points)
+        room_offsets, grid_starts, center_starts = store['room_offsets'], store['grid_starts'], store['center_starts']
+        rooms = range(len(rooms_split))
+        self.room_points = [store['points'][room_offsets[i]:room_offsets[i + 1]] for i in rooms]
+        self.room_labels = [store['labels'][room_offsets[i]:room_offsets[i + 1]] for i in rooms]
+        self.room_offsets = [store['grid_offsets'][grid_starts[i]:grid_starts[i + 1]] for i in rooms]
+        self.room_centers = [store['centers'][center_starts[i]:center_starts[i + 1]] for i in rooms]
+        self.room_grid_shape = [tuple(int(n) for n in shape) for shape in store['grid_shape']]
+        self.room_coord_min, self.room_coord_max = list(store['coord_min']), list(store['coord_max'])
+        num_point_all = np.diff(room_offsets)
+        labelweights = store['label_hist']
         labelweights = labelweights.astype(np.float32)
         labelweights = labelweights / np.sum(labelweights)
         self.labelweights = np.power(np.amax(labelweights) / labelweights, 1 / 3.0)
@@ -45,18 +150,35 @@ class S3DISDataset(Dataset):
         self.room_idxs = np.array(room_idxs)
         print("Totally {} samples in {} set.".format(len(self.room_idxs), split))
 
+    def query_block(self, room_idx, block_min, block_max):
+        """
+        Indices of the points of room room_idx inside [block_min, block_max] in the plane, only the points
+        of the grid cells overlapping the block are tested.
+        """
+        points = self.room_points[room_idx]
+        offsets, (nx, ny) = self.room_offsets[room_idx], self.room_grid_shape[room_idx]
+        coord_min = self.room_coord_min[room_idx][:2]
+        low = np.clip(np.floor((block_min[:2] - coord_min) / self.cell_size).astype(np.int64), 0, [nx - 1, ny - 1])
+        high = np.clip(np.floor((block_max[:2] - coord_min) / self.cell_size).astype(np.int64), 0, [nx - 1, ny - 1])
+        # the cells of one grid column are contiguous, one range of points per column
+        point_idxs = np.concatenate([np.arange(offsets[x * ny + low[1]], offsets[x * ny + high[1] + 1])
+                                     for x in range(low[0], high[0] + 1)])
+        xy = points[point_idxs, :2]
+        inside = (xy[:, 0] >= block_min[0]) & (xy[:, 0] <= block_max[0]) & (xy[:, 1] >= block_min[1]) & (xy[:, 1] <= block_max[1])
+        return point_idxs[inside]
+
     def __getitem__(self, idx):
         room_idx = self.room_idxs[idx]
         points = self.room_points[room_idx]   # N * 6
         labels = self.room_labels[room_idx]   # N
-        N_points = points.shape[0]
 
         while (True):
-            center = points[np.random.choice(N_points)][:3]
+            # uniform over the candidate centers and rejected like before, so uniform over the valid centers
+            center = points[np.random.choice(self.room_centers[room_idx])][:3]
             block_min = center - [self.block_size / 2.0, self.block_size / 2.0, 0]
             block_max = center + [self.block_size / 2.0, self.block_size / 2.0, 0]
-            point_idxs = np.where((points[:, 0] >= block_min[0]) & (points[:, 0] <= block_max[0]) & (points[:, 1] >= block_min[1]) & (points[:, 1] <= block_max[1]))[0]
-            if point_idxs.size > 1024:
+            point_idxs = self.query_block(room_idx, block_min, block_max)
+            if point_idxs.size > self.min_block_points:
                 break
 
         if point_idxs.size >= self.num_point:
@@ -95,7 +217,7 @@ class ScannetDatasetWholeScene():
         self.scene_points_num = []
         assert split in ['train', 'test']
         if self.split == 'train':
-            self.file_list = [d for d in os.listdir(root) if d.find('Area_%d' % test_area) == -1]
+            self.file_list = [d for d in os.listdir(root) if d.find('Area_%d' % test_area) == -1 and 'Area_' in d]
         else:
             self.file_list = [d for d in os.listdir(root) if d.find('Area_%d' % test_area) != -1]
         self.scene_points_list = []
@@ -119,49 +241,67 @@ class ScannetDatasetWholeScene():
         labelweights = labelweights / np.sum(labelweights)
         self.labelweights = np.power(np.amax(labelweights) / labelweights, 1 / 3.0)
 
-    def __getitem__(self, index):
-        point_set_ini = self.scene_points_list[index]
-        points = point_set_ini[:,:6]
-        labels = self.semantic_labels_list[index]
-        coord_min, coord_max = np.amin(points, axis=0)[:3], np.amax(points, axis=0)[:3]
+    def blocks(self, index):
+        """
+        Generator over the non-empty blocks of scene index, row by row like the sliding window.
+        The points are sorted by x once, then each column of blocks by y, so every block is two binary searches.
+        Return:
+            s_x, s_y: lower corner of the block
+            point_idxs: indices of the points inside the padded block, ascending
+        """
+        points = self.scene_points_list[index]
+        coord_min, coord_max = self.room_coord_min[index], self.room_coord_max[index]
         grid_x = int(np.ceil(float(coord_max[0] - coord_min[0] - self.block_size) / self.stride) + 1)
         grid_y = int(np.ceil(float(coord_max[1] - coord_min[1] - self.block_size) / self.stride) + 1)
-        data_room, label_room, sample_weight, index_room = np.array([]), np.array([]), np.array([]),  np.array([])
-        for index_y in range(0, grid_y):
-            for index_x in range(0, grid_x):
-                s_x = coord_min[0] + index_x * self.stride
-                e_x = min(s_x + self.block_size, coord_max[0])
-                s_x = e_x - self.block_size
-                s_y = coord_min[1] + index_y * self.stride
-                e_y = min(s_y + self.block_size, coord_max[1])
-                s_y = e_y - self.block_size
-                point_idxs = np.where(
-                    (points[:, 0] >= s_x - self.padding) & (points[:, 0] <= e_x + self.padding) & (points[:, 1] >= s_y - self.padding) & (
-                                points[:, 1] <= e_y + self.padding))[0]
-                if point_idxs.size == 0:
+        # the corners are computed in the dtype of the points, like the scalar arithmetic of the sliding window
+        e_x = np.minimum(coord_min[0] + (np.arange(grid_x) * self.stride).astype(points.dtype) + self.block_size, coord_max[0])
+        e_y = np.minimum(coord_min[1] + (np.arange(grid_y) * self.stride).astype(points.dtype) + self.block_size, coord_max[1])
+        s_x, s_y = e_x - self.block_size, e_y - self.block_size
+        order_x = np.argsort(points[:, 0], kind='stable')
+        sorted_x = points[order_x, 0]
+        low_x = np.searchsorted(sorted_x, s_x - self.padding, side='left')
+        high_x = np.searchsorted(sorted_x, e_x + self.padding, side='right')
+        columns = []
+        for index_x in range(grid_x):
+            column = order_x[low_x[index_x]:high_x[index_x]]
+            column = column[np.argsort(points[column, 1], kind='stable')]
+            sorted_y = points[column, 1]
+            low_y = np.searchsorted(sorted_y, s_y - self.padding, side='left')
+            high_y = np.searchsorted(sorted_y, e_y + self.padding, side='right')
+            columns.append((column, low_y, high_y))
+        for index_y in range(grid_y):
+            for index_x in range(grid_x):
+                column, low_y, high_y = columns[index_x]
+                if low_y[index_y] >= high_y[index_y]:
                     continue
-                num_batch = int(np.ceil(point_idxs.size / self.block_points))
-                point_size = int(num_batch * self.block_points)
-                replace = False if (point_size - point_idxs.size <= point_idxs.size) else True
-                point_idxs_repeat = np.random.choice(point_idxs, point_size - point_idxs.size, replace=replace)
-                point_idxs = np.concatenate((point_idxs, point_idxs_repeat))
-                np.random.shuffle(point_idxs)
-                data_batch = points[point_idxs, :]
-                normlized_xyz = np.zeros((point_size, 3))
-                normlized_xyz[:, 0] = data_batch[:, 0] / coord_max[0]
-                normlized_xyz[:, 1] = data_batch[:, 1] / coord_max[1]
-                normlized_xyz[:, 2] = data_batch[:, 2] / coord_max[2]
-                data_batch[:, 0] = data_batch[:, 0] - (s_x + self.block_size / 2.0)
-                data_batch[:, 1] = data_batch[:, 1] - (s_y + self.block_size / 2.0)
-                data_batch[:, 3:6] /= 255.0
-                data_batch = np.concatenate((data_batch, normlized_xyz), axis=1)
-                label_batch = labels[point_idxs].astype(int)
-                batch_weight = self.labelweights[label_batch]
-
-                data_room = np.vstack([data_room, data_batch]) if data_room.size else data_batch
-                label_room = np.hstack([label_room, label_batch]) if label_room.size else label_batch
-                sample_weight = np.hstack([sample_weight, batch_weight]) if label_room.size else batch_weight
-                index_room = np.hstack([index_room, point_idxs]) if index_room.size else point_idxs
+                yield s_x[index_x], s_y[index_y], np.sort(column[low_y[index_y]:high_y[index_y]])
+
+    def __getitem__(self, index):
+        points = self.scene_points_list[index][:, :6]
+        labels = self.semantic_labels_list[index]
+        coord_max = self.room_coord_max[index]
+        # the blocks are padded to multiples of block_points with random repeats, then gathered all at once
+        point_idxs_all, centers = [], []
+        for s_x, s_y, point_idxs in self.blocks(index):
+            num_batch = int(np.ceil(point_idxs.size / self.block_points))
+            point_size = int(num_batch * self.block_points)
+            replace = False if (point_size - point_idxs.size <= point_idxs.size) else True
+            point_idxs_repeat = np.random.choice(point_idxs, point_size - point_idxs.size, replace=replace)
+            point_idxs = np.concatenate((point_idxs, point_idxs_repeat))
+            np.random.shuffle(point_idxs)
+            point_idxs_all.append(point_idxs)
+            centers.append(((s_x + self.block_size / 2.0, s_y + self.block_size / 2.0), point_size))
+        index_room = np.concatenate(point_idxs_all) if point_idxs_all else np.zeros(0, dtype=np.int64)
+        # normalized in the dtype of the points, only the result is promoted to float64 as before
+        data_room = np.empty((index_room.size, 9), dtype=points.dtype)
+        data_room[:, 0:6] = points[index_room]
+        data_room[:, 6:9] = data_room[:, 0:3] / coord_max
+        centers_room = np.array([c for c, _ in centers], dtype=points.dtype).reshape(-1, 2)
+        data_room[:, 0:2] -= np.repeat(centers_room, [n for _, n in centers], axis=0)
+        data_room[:, 3:6] /= 255.0
+        data_room = data_room.astype(np.result_type(points.dtype, np.float64))
+        label_room = labels[index_room].astype(int)
+        sample_weight = self.labelweights[label_room].astype(np.float64)  # was promoted by the hstack onto np.array([])
         data_room = data_room.reshape((-1, self.block_points, data_room.shape[1]))
         label_room = label_room.reshape((-1, self.block_points))
         sample_weight = sample_weight.reshape((-1, self.block_points))
@@ -113,6 +113,113 @@ def point_label_to_obj(input_filename, out_filename, label_color=True, easy_view
  
 
 
+# -----------------------------------------------------------------------------
+# BULK EXPORT OF SCENES AND PREDICTIONS
+# -----------------------------------------------------------------------------
+
+g_label_colors = np.array([g_label2color[i] for i in range(len(g_classes))], dtype=np.uint8)
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1', 'short': 'i2', 'int16': 'i2',
+             'ushort': 'u2', 'uint16': 'u2', 'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+
+
+def write_ply(filename, xyz, rgb, label=None):
+    """ Write points as a binary little endian PLY in one call.
+    Args:
+        xyz: N x 3 coordinates, stored as float32
+        rgb: N x 3 colors in [0, 255], stored as uchar
+        label: optional N labels, stored as an int property 'label'
+    """
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    if label is not None:
+        fields.append(('label', '<i4'))
+    vertex = np.empty(xyz.shape[0], dtype=fields)
+    vertex['x'], vertex['y'], vertex['z'] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+    vertex['red'], vertex['green'], vertex['blue'] = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    if label is not None:
+        vertex['label'] = label
+    types = {'<f4': 'float', 'u1': 'uchar', '<i4': 'int'}
+    header = ['ply', 'format binary_little_endian 1.0', 'element vertex %d' % xyz.shape[0]]
+    header += ['property %s %s' % (types[t], name) for name, t in fields]
+    header += ['end_header']
+    with open(filename, 'wb') as fout:
+        fout.write(('\n'.join(header) + '\n').encode('ascii'))
+        vertex.tofile(fout)
+
+
+def read_ply(filename):
+    """ Read the vertices of a binary PLY, e.g. from write_ply, in one call.
+    Returns:
+        structured array with one field per vertex property
+    """
+    with open(filename, 'rb') as fin:
+        assert fin.readline().strip() == b'ply', '%s is not a PLY file' % filename
+        fields, num_vertex, element, endian = [], 0, None, '<'
+        while True:
+            line = fin.readline().decode('ascii').split()
+            if not line or line[0] == 'comment':
+                continue
+            if line[0] == 'end_header':
+                break
+            if line[0] == 'format':
+                assert line[1] != 'ascii', 'ascii PLY is not supported: %s' % filename
+                endian = '<' if line[1] == 'binary_little_endian' else '>'
+            elif line[0] == 'element':
+                element = line[1]
+                if element == 'vertex':
+                    num_vertex = int(line[2])
+            elif line[0] == 'property' and element == 'vertex':
+                fields.append((line[2], endian + PLY_TYPES[line[1]]))
+        return np.fromfile(fin, dtype=fields, count=num_vertex)
+
+
+def write_scene(prefix, xyz, pred, gt, file_format='ply'):
+    """ Export the predicted and ground truth labels of a scene, colored by g_label2color.
+    Args:
+        prefix: output path without extension
+        xyz: N x 3 coordinates
+        pred, gt: N labels
+        file_format: ply (prefix_pred.ply and prefix_gt.ply), npz (prefix.npz) or obj
+    """
+    pred, gt = np.asarray(pred).astype(int), np.asarray(gt).astype(int)
+    if file_format == 'ply':
+        write_ply(prefix + '_pred.ply', xyz, g_label_colors[pred], pred)
+        write_ply(prefix + '_gt.ply', xyz, g_label_colors[gt], gt)
+    elif file_format == 'npz':
+        np.savez(prefix + '.npz', xyz=xyz.astype(np.float32), pred=pred.astype(np.uint8), gt=gt.astype(np.uint8))
+    elif file_format == 'obj':
+        # still text, but formatted from python lists in one join instead of one write per point
+        for name, label in [('_pred.obj', pred), ('_gt.obj', gt)]:
+            rows = zip(*np.asarray(xyz).T.tolist(), *g_label_colors[label].T.tolist())
+            with open(prefix + name, 'w') as fout:
+                fout.write(''.join(map('v %f %f %f %d %d %d\n'.__mod__, rows)))
+    else:
+        print('ERROR!! Unknown file format: %s, please use ply, npz or obj.' % \
+            (file_format))
+        exit()
+
+
+def read_points(filename, key='pred'):
+    """ Read the points and colors of a file from write_scene.
+    Args:
+        key: labels colored for npz files, pred or gt
+    Returns:
+        xyz: N x 3 coordinates
+        rgb: N x 3 colors in [0, 255]
+    """
+    if filename.endswith('.ply'):
+        vertex = read_ply(filename)
+        xyz = np.stack([vertex['x'], vertex['y'], vertex['z']], 1)
+        rgb = np.stack([vertex['red'], vertex['green'], vertex['blue']], 1)
+    elif filename.endswith('.npz'):
+        scene = np.load(filename)
+        xyz, rgb = scene['xyz'], g_label_colors[scene[key]]
+    else:  # obj, one 'v x y z r g b' line per point
+        data = np.loadtxt(filename, usecols=range(1, 7), ndmin=2)
+        xyz, rgb = data[:, 0:3], data[:, 3:6].astype(np.uint8)
+    return xyz, rgb
+
+
 # -----------------------------------------------------------------------------
 # PREPARE BLOCK DATA FOR DEEPNETS TRAINING/TESTING
 # -----------------------------------------------------------------------------
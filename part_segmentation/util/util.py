@@ -1,5 +1,7 @@
+import os
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 
 
@@ -23,18 +25,93 @@ def cal_loss(pred, gold, smoothing=True):
     return loss
 
 
-# create a file and write the text into it:
+PRECISIONS = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def get_autocast(device, precision='fp32'):
+    ''' Autocast context of --precision, a no-op for fp32. '''
+    dtype = PRECISIONS[precision]
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype, enabled=dtype is not None)
+
+
+class PassThroughScaler(object):
+    ''' The GradScaler interface without loss scaling, for fp32 and bf16 on any torch version. '''
+    def scale(self, loss):
+        return loss
+
+    def unscale_(self, optimizer):
+        pass
+
+    def step(self, optimizer, *args, **kwargs):
+        return optimizer.step(*args, **kwargs)
+
+    def update(self, new_scale=None):
+        pass
+
+    def is_enabled(self):
+        return False
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state_dict):
+        pass
+
+
+def get_grad_scaler(device, precision='fp32'):
+    ''' Loss scaling is only needed for fp16, for fp32 and bf16 the scaler is a pass-through. '''
+    if precision != 'fp16':
+        return PassThroughScaler()
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):  # torch>=2.3, any device
+        return torch.amp.GradScaler(torch.device(device).type)
+    assert torch.device(device).type == 'cuda', "fp16 training needs CUDA on this torch version, please use bf16."
+    return torch.cuda.amp.GradScaler()
+
+
+def init_distributed():
+    ''' Joins the process group started by torchrun, nccl with CUDA and gloo otherwise.
+        Returns the rank, the world size and the local rank. '''
+    dist.init_process_group('nccl' if torch.cuda.is_available() else 'gloo')
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+    return dist.get_rank(), dist.get_world_size(), local_rank
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def shard_indices(length):
+    ''' Evaluation samples of this rank, strided and without the padding of DistributedSampler. '''
+    if not dist.is_initialized():
+        return list(range(length))
+    return list(range(dist.get_rank(), length, dist.get_world_size()))
+
+
+def all_reduce_sum(*tensors):
+    ''' Sums the epoch statistics of all ranks in place, every rank has to call it. '''
+    if dist.is_initialized():
+        for tensor in tensors:
+            dist.all_reduce(tensor)
+    return tensors
+
+
+# create a file and write the text into it, only rank 0 writes:
 class IOStream():
     def __init__(self, path):
-        self.f = open(path, 'a')
+        self.f = open(path, 'a') if is_main_process() else None
 
     def cprint(self, text):
+        if self.f is None:
+            return
         print(text)
         self.f.write(text+'\n')
         self.f.flush()
 
     def close(self):
-        self.f.close()
+        if self.f is not None:
+            self.f.close()
 
 
 def to_categorical(y, num_classes):
@@ -45,25 +122,38 @@ def to_categorical(y, num_classes):
     return new_y
 
 
+def part_confusion(pred, target, num_classes):
+    """
+    Input:
+        pred: predicted part of every point, [B, N]
+        target: ground truth part of every point, [B, N]
+    Return:
+        confusion: per shape point counts of (target, pred) pairs, one bincount on the device of pred, [B, C, C]
+    """
+    B = pred.size(0)
+    shape_idx = torch.arange(B, device=pred.device).view(-1, 1)
+    keys = (shape_idx * num_classes + target) * num_classes + pred
+    return torch.bincount(keys.view(-1), minlength=B * num_classes ** 2).view(B, num_classes, num_classes)
+
+
+def compute_shape_ious(pred, target, num_classes):
+    """
+    Input:
+        pred: log probabilities, [B, N, C]
+        target: ground truth part of every point, [B, N]
+    Return:
+        shape_ious: mean iou over the parts present in the target of each shape, on device, [B]
+        present: parts present in the target of each shape, [B, C]
+    """
+    confusion = part_confusion(pred.max(dim=2)[1], target, num_classes)
+    I = torch.diagonal(confusion, dim1=1, dim2=2)
+    F = confusion.sum(dim=2)  # points of each part in the target
+    U = F + confusion.sum(dim=1) - I
+    present = F != 0
+    ious = torch.where(present, I.double() / U.clamp(min=1), torch.zeros_like(I, dtype=torch.float64))
+    return ious.sum(dim=1) / present.sum(dim=1), present
+
+
 def compute_overall_iou(pred, target, num_classes):
-    shape_ious = []
-    pred = pred.max(dim=2)[1]    # (batch_size, num_points)  the pred_class_idx of each point in each sample
-    pred_np = pred.cpu().data.numpy()
-
-    target_np = target.cpu().data.numpy()
-    for shape_idx in range(pred.size(0)):   # sample_idx
-        part_ious = []
-        for part in range(num_classes):   # class_idx! no matter which category, only consider all part_classes of all categories, check all 50 classes
-            # for target, each point has a class no matter which category owns this point! also 50 classes!!!
-            # only return 1 when both belongs to this class, which means correct:
-            I = np.sum(np.logical_and(pred_np[shape_idx] == part, target_np[shape_idx] == part))
-            # always return 1 when either is belongs to this class:
-            U = np.sum(np.logical_or(pred_np[shape_idx] == part, target_np[shape_idx] == part))
-
-            F = np.sum(target_np[shape_idx] == part)
-
-            if F != 0:
-                iou = I / float(U)    #  iou across all points for this class
-                part_ious.append(iou)   #  append the iou of this class
-        shape_ious.append(np.mean(part_ious))   # each time append an average iou across all classes of this sample (sample_level!)
-    return shape_ious   # [batch_size]
+    shape_ious, _ = compute_shape_ious(pred, target, num_classes)
+    return shape_ious.tolist()   # [batch_size]
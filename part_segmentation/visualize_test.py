@@ -5,7 +5,7 @@ Date: Nov 2019
 import argparse
 import os
 from util.S3DISDataLoader import ScannetDatasetWholeScene
-from util.indoor3d_util import g_label2color
+from util.indoor3d_util import write_scene
 import torch
 import logging
 from pathlib import Path
@@ -41,16 +41,38 @@ def parse_args():
     parser.add_argument('--visual', action='store_true', default=True, help='visualize result [default: False]')
     parser.add_argument('--test_area', type=int, default=5, help='area for testing, option: 1-6 [default: 5]')
     parser.add_argument('--num_votes', type=int, default=3, help='aggregate segmentation scores with voting [default: 5]')
+    parser.add_argument('--export_format', type=str, default='ply', choices=['ply', 'npz', 'obj'], help='format of the visualized scenes [default: ply]')
+    parser.add_argument('--soft_vote', action='store_true', default=False, help='sum class probabilities instead of predicted labels')
     return parser.parse_args()
 
 
 def add_vote(vote_label_pool, point_idx, pred_label, weight):
-    B = pred_label.shape[0]
-    N = pred_label.shape[1]
-    for b in range(B):
-        for n in range(N):
-            if weight[b, n] != 0 and not np.isinf(weight[b, n]):
-                vote_label_pool[int(point_idx[b, n]), int(pred_label[b, n])] += 1
+    """
+    Input:
+        vote_label_pool: votes of every point of the scene, [P, C], numpy array or tensor
+        point_idx: scene point of every prediction, [B, N]
+        pred_label: predicted class, [B, N], or class probabilities summed as soft votes, [B, N, C]
+        weight: sample weights, predictions with a zero or infinite weight are skipped, [B, N]
+    Return:
+        vote_label_pool: updated in place with one scatter-add, on the device of the pool
+    """
+    if torch.is_tensor(vote_label_pool):
+        device = vote_label_pool.device
+        point_idx, pred_label, weight = [torch.as_tensor(x, device=device) for x in (point_idx, pred_label, weight)]
+        valid = (weight != 0) & ~torch.isinf(weight)
+        point_idx = point_idx[valid].long()
+        if pred_label.dim() == 3:
+            vote_label_pool.index_add_(0, point_idx, pred_label[valid].to(vote_label_pool.dtype))
+        else:
+            votes = torch.ones(point_idx.shape[0], dtype=vote_label_pool.dtype, device=device)
+            vote_label_pool.index_put_((point_idx, pred_label[valid].long()), votes, accumulate=True)
+        return vote_label_pool
+    valid = (weight != 0) & ~np.isinf(weight)
+    point_idx = point_idx[valid].astype(np.int64)
+    if pred_label.ndim == 3:
+        np.add.at(vote_label_pool, point_idx, pred_label[valid])
+    else:
+        np.add.at(vote_label_pool, (point_idx, pred_label[valid].astype(np.int64)), 1)
     return vote_label_pool
 
 
@@ -128,13 +150,10 @@ def main(args):
             total_seen_class_tmp = [0 for _ in range(NUM_CLASSES)]
             total_correct_class_tmp = [0 for _ in range(NUM_CLASSES)]
             total_iou_deno_class_tmp = [0 for _ in range(NUM_CLASSES)]
-            if args.visual:
-                fout = open(os.path.join(visual_dir, scene_id[batch_idx] + '_pred.obj'), 'w')
-                fout_gt = open(os.path.join(visual_dir, scene_id[batch_idx] + '_gt.obj'), 'w')
 
             whole_scene_data = TEST_DATASET_WHOLE_SCENE.scene_points_list[batch_idx]
             whole_scene_label = TEST_DATASET_WHOLE_SCENE.semantic_labels_list[batch_idx]
-            vote_label_pool = np.zeros((whole_scene_label.shape[0], NUM_CLASSES))
+            vote_label_pool = torch.zeros((whole_scene_label.shape[0], NUM_CLASSES), device=device)
             for _ in tqdm(range(args.num_votes), total=args.num_votes):
                 scene_data, scene_label, scene_smpw, scene_point_index = TEST_DATASET_WHOLE_SCENE[batch_idx]
                 num_blocks = scene_data.shape[0]
@@ -170,13 +189,14 @@ def main(args):
                     #seg_pred, _ = classifier(torch_data)
                     #seg_pred = classifier(torch_data[:, :3, :],torch_data[:, 3:6, :],torch_data[:, 6:, :])
                     seg_pred = classifier(torch_data[:, :3, :],normals,torch_data[:, 3:6, :])
-                    batch_pred_label = seg_pred.contiguous().cpu().data.max(2)[1].numpy()
+                    # the votes stay on the device, only the final labels are copied back
+                    batch_pred_label = seg_pred.exp() if args.soft_vote else seg_pred.max(2)[1]
 
                     vote_label_pool = add_vote(vote_label_pool, batch_point_index[0:real_batch_size, ...],
                                                batch_pred_label[0:real_batch_size, ...],
                                                batch_smpw[0:real_batch_size, ...])
 
-            pred_label = np.argmax(vote_label_pool, 1)
+            pred_label = vote_label_pool.argmax(1).cpu().numpy()
 
             for l in range(NUM_CLASSES):
                 total_seen_class_tmp[l] += np.sum((whole_scene_label == l))
@@ -193,25 +213,11 @@ def main(args):
             log_string('Mean IoU of %s: %.4f' % (scene_id[batch_idx], tmp_iou))
             print('----------------------------')
 
-            filename = os.path.join(visual_dir, scene_id[batch_idx] + '.txt')
-            with open(filename, 'w') as pl_save:
-                for i in pred_label:
-                    pl_save.write(str(int(i)) + '\n')
-                pl_save.close()
-            for i in range(whole_scene_label.shape[0]):
-                color = g_label2color[pred_label[i]]
-                color_gt = g_label2color[whole_scene_label[i]]
-                if args.visual:
-                    fout.write('v %f %f %f %d %d %d\n' % (
-                        whole_scene_data[i, 0], whole_scene_data[i, 1], whole_scene_data[i, 2], color[0], color[1],
-                        color[2]))
-                    fout_gt.write(
-                        'v %f %f %f %d %d %d\n' % (
-                            whole_scene_data[i, 0], whole_scene_data[i, 1], whole_scene_data[i, 2], color_gt[0],
-                            color_gt[1], color_gt[2]))
+            # the predicted label of every point, one per line, whatever the export format
+            np.savetxt(os.path.join(visual_dir, scene_id[batch_idx] + '.txt'), pred_label, fmt='%d')
             if args.visual:
-                fout.close()
-                fout_gt.close()
+                write_scene(os.path.join(visual_dir, scene_id[batch_idx]), whole_scene_data[:, :3], pred_label,
+                            whole_scene_label, args.export_format)
 
         IoU = np.array(total_correct_class) / (np.array(total_iou_deno_class, dtype=float) + 1e-6)
         iou_per_class_str = '------- IoU --------\n'
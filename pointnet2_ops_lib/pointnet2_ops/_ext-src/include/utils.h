@@ -1,5 +1,4 @@
 #pragma once
-#include <ATen/cuda/CUDAContext.h>
 #include <torch/extension.h>
 
 #define CHECK_CUDA(x)                                    \
@@ -7,6 +6,11 @@
     AT_ASSERT(x.is_cuda(), #x " must be a CUDA tensor"); \
   } while (0)
 
+#define CHECK_CPU(x)                                    \
+  do {                                                  \
+    AT_ASSERT(!x.is_cuda(), #x " must be a CPU tensor"); \
+  } while (0)
+
 #define CHECK_CONTIGUOUS(x)                                          \
   do {                                                               \
     AT_ASSERT(x.is_contiguous(), #x " must be a contiguous tensor"); \
@@ -4,6 +4,9 @@
 void query_ball_point_kernel_wrapper(int b, int n, int m, float radius,
                                      int nsample, const float *new_xyz,
                                      const float *xyz, int *idx);
+void query_ball_point_kernel_cpu(int b, int n, int m, float radius,
+                                 int nsample, const float *new_xyz,
+                                 const float *xyz, int *idx);
 
 at::Tensor ball_query(at::Tensor new_xyz, at::Tensor xyz, const float radius,
                       const int nsample) {
@@ -14,6 +17,8 @@ at::Tensor ball_query(at::Tensor new_xyz, at::Tensor xyz, const float radius,
 
   if (new_xyz.is_cuda()) {
     CHECK_CUDA(xyz);
+  } else {
+    CHECK_CPU(xyz);
   }
 
   at::Tensor idx =
@@ -21,11 +26,17 @@ at::Tensor ball_query(at::Tensor new_xyz, at::Tensor xyz, const float radius,
                    at::device(new_xyz.device()).dtype(at::ScalarType::Int));
 
   if (new_xyz.is_cuda()) {
+#ifdef WITH_CUDA
     query_ball_point_kernel_wrapper(xyz.size(0), xyz.size(1), new_xyz.size(1),
                                     radius, nsample, new_xyz.data_ptr<float>(),
                                     xyz.data_ptr<float>(), idx.data_ptr<int>());
+#else
+    AT_ASSERT(false, "pointnet2_ops was built without CUDA support");
+#endif
   } else {
-    AT_ASSERT(false, "CPU not supported");
+    query_ball_point_kernel_cpu(xyz.size(0), xyz.size(1), new_xyz.size(1), radius,
+                                nsample, new_xyz.data_ptr<float>(),
+                                xyz.data_ptr<float>(), idx.data_ptr<int>());
   }
 
   return idx;
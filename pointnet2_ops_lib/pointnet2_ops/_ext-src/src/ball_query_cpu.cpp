@@ -0,0 +1,35 @@
+#include <ATen/Parallel.h>
+
+// input: new_xyz(b, m, 3) xyz(b, n, 3)
+// output: idx(b, m, nsample)
+void query_ball_point_kernel_cpu(int b, int n, int m, float radius,
+                                 int nsample, const float *new_xyz,
+                                 const float *xyz, int *idx) {
+  const float radius2 = radius * radius;
+  at::parallel_for(0, b * m, 0, [&](int64_t start, int64_t end) {
+    for (int64_t query = start; query < end; ++query) {
+      const int batch_index = query / m;
+      const float *batch_xyz = xyz + batch_index * n * 3;
+      int *query_idx = idx + query * nsample;
+      const float new_x = new_xyz[query * 3 + 0];
+      const float new_y = new_xyz[query * 3 + 1];
+      const float new_z = new_xyz[query * 3 + 2];
+      for (int k = 0, cnt = 0; k < n && cnt < nsample; ++k) {
+        const float x = batch_xyz[k * 3 + 0];
+        const float y = batch_xyz[k * 3 + 1];
+        const float z = batch_xyz[k * 3 + 2];
+        const float d2 = (new_x - x) * (new_x - x) + (new_y - y) * (new_y - y) +
+                         (new_z - z) * (new_z - z);
+        if (d2 < radius2) {
+          if (cnt == 0) {
+            for (int l = 0; l < nsample; ++l) {
+              query_idx[l] = k;
+            }
+          }
+          query_idx[cnt] = k;
+          ++cnt;
+        }
+      }
+    }
+  });
+}
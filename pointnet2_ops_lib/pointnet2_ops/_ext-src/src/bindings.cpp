@@ -3,7 +3,17 @@
 #include "interpolate.h"
 #include "sampling.h"
 
+bool with_cuda() {
+#ifdef WITH_CUDA
+  return true;
+#else
+  return false;
+#endif
+}
+
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+  m.def("with_cuda", &with_cuda);
+
   m.def("gather_points", &gather_points);
   m.def("gather_points_grad", &gather_points_grad);
   m.def("furthest_point_sampling", &furthest_point_sampling);
@@ -0,0 +1,36 @@
+#include <ATen/Parallel.h>
+
+// input: points(b, c, n) idx(b, npoints, nsample)
+// output: out(b, c, npoints, nsample)
+void group_points_kernel_cpu(int b, int c, int n, int npoints, int nsample,
+                             const float *points, const int *idx, float *out) {
+  at::parallel_for(0, b * c, 0, [&](int64_t start, int64_t end) {
+    for (int64_t row = start; row < end; ++row) {
+      const int i = row / c;
+      const float *points_row = points + row * n;
+      const int *idx_batch = idx + i * npoints * nsample;
+      float *out_row = out + row * npoints * nsample;
+      for (int j = 0; j < npoints * nsample; ++j) {
+        out_row[j] = points_row[idx_batch[j]];
+      }
+    }
+  });
+}
+
+// input: grad_out(b, c, npoints, nsample), idx(b, npoints, nsample)
+// output: grad_points(b, c, n)
+void group_points_grad_kernel_cpu(int b, int c, int n, int npoints,
+                                  int nsample, const float *grad_out,
+                                  const int *idx, float *grad_points) {
+  at::parallel_for(0, b * c, 0, [&](int64_t start, int64_t end) {
+    for (int64_t row = start; row < end; ++row) {
+      const int i = row / c;
+      const float *grad_out_row = grad_out + row * npoints * nsample;
+      const int *idx_batch = idx + i * npoints * nsample;
+      float *grad_points_row = grad_points + row * n;
+      for (int j = 0; j < npoints * nsample; ++j) {
+        grad_points_row[idx_batch[j]] += grad_out_row[j];
+      }
+    }
+  });
+}
@@ -0,0 +1,93 @@
+#include <ATen/Parallel.h>
+
+// input: unknown(b, n, 3) known(b, m, 3)
+// output: dist2(b, n, 3), idx(b, n, 3)
+void three_nn_kernel_cpu(int b, int n, int m, const float *unknown,
+                         const float *known, float *dist2, int *idx) {
+  at::parallel_for(0, b * n, 0, [&](int64_t start, int64_t end) {
+    for (int64_t point = start; point < end; ++point) {
+      const int batch_index = point / n;
+      const float *batch_known = known + batch_index * m * 3;
+      const float ux = unknown[point * 3 + 0];
+      const float uy = unknown[point * 3 + 1];
+      const float uz = unknown[point * 3 + 2];
+
+      double best1 = 1e40, best2 = 1e40, best3 = 1e40;
+      int besti1 = 0, besti2 = 0, besti3 = 0;
+      for (int k = 0; k < m; ++k) {
+        const float x = batch_known[k * 3 + 0];
+        const float y = batch_known[k * 3 + 1];
+        const float z = batch_known[k * 3 + 2];
+        const float d =
+            (ux - x) * (ux - x) + (uy - y) * (uy - y) + (uz - z) * (uz - z);
+        if (d < best1) {
+          best3 = best2;
+          besti3 = besti2;
+          best2 = best1;
+          besti2 = besti1;
+          best1 = d;
+          besti1 = k;
+        } else if (d < best2) {
+          best3 = best2;
+          besti3 = besti2;
+          best2 = d;
+          besti2 = k;
+        } else if (d < best3) {
+          best3 = d;
+          besti3 = k;
+        }
+      }
+      dist2[point * 3 + 0] = best1;
+      dist2[point * 3 + 1] = best2;
+      dist2[point * 3 + 2] = best3;
+
+      idx[point * 3 + 0] = besti1;
+      idx[point * 3 + 1] = besti2;
+      idx[point * 3 + 2] = besti3;
+    }
+  });
+}
+
+// input: points(b, c, m), idx(b, n, 3), weight(b, n, 3)
+// output: out(b, c, n)
+void three_interpolate_kernel_cpu(int b, int c, int m, int n,
+                                  const float *points, const int *idx,
+                                  const float *weight, float *out) {
+  at::parallel_for(0, b * c, 0, [&](int64_t start, int64_t end) {
+    for (int64_t row = start; row < end; ++row) {
+      const int i = row / c;
+      const float *points_row = points + row * m;
+      const int *idx_batch = idx + i * n * 3;
+      const float *weight_batch = weight + i * n * 3;
+      float *out_row = out + row * n;
+      for (int j = 0; j < n; ++j) {
+        out_row[j] = points_row[idx_batch[j * 3 + 0]] * weight_batch[j * 3 + 0] +
+                     points_row[idx_batch[j * 3 + 1]] * weight_batch[j * 3 + 1] +
+                     points_row[idx_batch[j * 3 + 2]] * weight_batch[j * 3 + 2];
+      }
+    }
+  });
+}
+
+// input: grad_out(b, c, n), idx(b, n, 3), weight(b, n, 3)
+// output: grad_points(b, c, m)
+void three_interpolate_grad_kernel_cpu(int b, int c, int n, int m,
+                                       const float *grad_out, const int *idx,
+                                       const float *weight,
+                                       float *grad_points) {
+  at::parallel_for(0, b * c, 0, [&](int64_t start, int64_t end) {
+    for (int64_t row = start; row < end; ++row) {
+      const int i = row / c;
+      const float *grad_out_row = grad_out + row * n;
+      const int *idx_batch = idx + i * n * 3;
+      const float *weight_batch = weight + i * n * 3;
+      float *grad_points_row = grad_points + row * m;
+      for (int j = 0; j < n; ++j) {
+        const float g = grad_out_row[j];
+        grad_points_row[idx_batch[j * 3 + 0]] += g * weight_batch[j * 3 + 0];
+        grad_points_row[idx_batch[j * 3 + 1]] += g * weight_batch[j * 3 + 1];
+        grad_points_row[idx_batch[j * 3 + 2]] += g * weight_batch[j * 3 + 2];
+      }
+    }
+  });
+}
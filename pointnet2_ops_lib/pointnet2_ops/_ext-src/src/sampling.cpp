@@ -12,6 +12,15 @@ void furthest_point_sampling_kernel_wrapper(int b, int n, int m,
                                             const float *dataset, float *temp,
                                             int *idxs);
 
+void gather_points_kernel_cpu(int b, int c, int n, int npoints,
+                              const float *points, const int *idx, float *out);
+void gather_points_grad_kernel_cpu(int b, int c, int n, int npoints,
+                                   const float *grad_out, const int *idx,
+                                   float *grad_points);
+void furthest_point_sampling_kernel_cpu(int b, int n, int m,
+                                        const float *dataset, float *temp,
+                                        int *idxs);
+
 at::Tensor gather_points(at::Tensor points, at::Tensor idx) {
   CHECK_CONTIGUOUS(points);
   CHECK_CONTIGUOUS(idx);
@@ -20,6 +29,8 @@ at::Tensor gather_points(at::Tensor points, at::Tensor idx) {
 
   if (points.is_cuda()) {
     CHECK_CUDA(idx);
+  } else {
+    CHECK_CPU(idx);
   }
 
   at::Tensor output =
@@ -27,11 +38,17 @@ at::Tensor gather_points(at::Tensor points, at::Tensor idx) {
                    at::device(points.device()).dtype(at::ScalarType::Float));
 
   if (points.is_cuda()) {
+#ifdef WITH_CUDA
     gather_points_kernel_wrapper(points.size(0), points.size(1), points.size(2),
                                  idx.size(1), points.data_ptr<float>(),
                                  idx.data_ptr<int>(), output.data_ptr<float>());
+#else
+    AT_ASSERT(false, "pointnet2_ops was built without CUDA support");
+#endif
   } else {
-    AT_ASSERT(false, "CPU not supported");
+    gather_points_kernel_cpu(points.size(0), points.size(1), points.size(2),
+                             idx.size(1), points.data_ptr<float>(),
+                             idx.data_ptr<int>(), output.data_ptr<float>());
   }
 
   return output;
@@ -46,6 +63,8 @@ at::Tensor gather_points_grad(at::Tensor grad_out, at::Tensor idx,
 
   if (grad_out.is_cuda()) {
     CHECK_CUDA(idx);
+  } else {
+    CHECK_CPU(idx);
   }
 
   at::Tensor output =
@@ -53,12 +72,18 @@ at::Tensor gather_points_grad(at::Tensor grad_out, at::Tensor idx,
                    at::device(grad_out.device()).dtype(at::ScalarType::Float));
 
   if (grad_out.is_cuda()) {
+#ifdef WITH_CUDA
     gather_points_grad_kernel_wrapper(grad_out.size(0), grad_out.size(1), n,
                                       idx.size(1), grad_out.data_ptr<float>(),
                                       idx.data_ptr<int>(),
                                       output.data_ptr<float>());
+#else
+    AT_ASSERT(false, "pointnet2_ops was built without CUDA support");
+#endif
   } else {
-    AT_ASSERT(false, "CPU not supported");
+    gather_points_grad_kernel_cpu(grad_out.size(0), grad_out.size(1), n,
+                                  idx.size(1), grad_out.data_ptr<float>(),
+                                  idx.data_ptr<int>(), output.data_ptr<float>());
   }
 
   return output;
@@ -76,11 +101,17 @@ at::Tensor furthest_point_sampling(at::Tensor points, const int nsamples) {
                   at::device(points.device()).dtype(at::ScalarType::Float));
 
   if (points.is_cuda()) {
+#ifdef WITH_CUDA
     furthest_point_sampling_kernel_wrapper(
         points.size(0), points.size(1), nsamples, points.data_ptr<float>(),
         tmp.data_ptr<float>(), output.data_ptr<int>());
+#else
+    AT_ASSERT(false, "pointnet2_ops was built without CUDA support");
+#endif
   } else {
-    AT_ASSERT(false, "CPU not supported");
+    furthest_point_sampling_kernel_cpu(
+        points.size(0), points.size(1), nsamples, points.data_ptr<float>(),
+        tmp.data_ptr<float>(), output.data_ptr<int>());
   }
 
   return output;
@@ -0,0 +1,86 @@
+#include <ATen/Parallel.h>
+
+#include <algorithm>
+
+
+// input: points(b, c, n) idx(b, m)
+// output: out(b, c, m)
+void gather_points_kernel_cpu(int b, int c, int n, int m, const float *points,
+                              const int *idx, float *out) {
+  at::parallel_for(0, b * c, 0, [&](int64_t start, int64_t end) {
+    for (int64_t row = start; row < end; ++row) {
+      const int i = row / c;
+      const float *points_row = points + row * n;
+      const int *idx_row = idx + i * m;
+      float *out_row = out + row * m;
+      for (int j = 0; j < m; ++j) {
+        out_row[j] = points_row[idx_row[j]];
+      }
+    }
+  });
+}
+
+// input: grad_out(b, c, m) idx(b, m)
+// output: grad_points(b, c, n)
+void gather_points_grad_kernel_cpu(int b, int c, int n, int m,
+                                   const float *grad_out, const int *idx,
+                                   float *grad_points) {
+  // Each (batch, channel) row is owned by a single thread, so the scatter
+  // needs no atomics.
+  at::parallel_for(0, b * c, 0, [&](int64_t start, int64_t end) {
+    for (int64_t row = start; row < end; ++row) {
+      const int i = row / c;
+      const float *grad_out_row = grad_out + row * m;
+      const int *idx_row = idx + i * m;
+      float *grad_points_row = grad_points + row * n;
+      for (int j = 0; j < m; ++j) {
+        grad_points_row[idx_row[j]] += grad_out_row[j];
+      }
+    }
+  });
+}
+
+// Input dataset: (b, n, 3), tmp: (b, n)
+// Ouput idxs (b, m)
+void furthest_point_sampling_kernel_cpu(int b, int n, int m,
+                                        const float *dataset, float *temp,
+                                        int *idxs) {
+  if (m <= 0) return;
+  at::parallel_for(0, b, 1, [&](int64_t start, int64_t end) {
+    for (int64_t batch_index = start; batch_index < end; ++batch_index) {
+      const float *batch_dataset = dataset + batch_index * n * 3;
+      float *batch_temp = temp + batch_index * n;
+      int *batch_idxs = idxs + batch_index * m;
+
+      // Mirrors the CUDA kernel: start from point 0 and ignore points that
+      // sit (almost) exactly at the origin.
+      int old = 0;
+      batch_idxs[0] = old;
+      for (int j = 1; j < m; ++j) {
+        int besti = 0;
+        float best = -1;
+        const float x1 = batch_dataset[old * 3 + 0];
+        const float y1 = batch_dataset[old * 3 + 1];
+        const float z1 = batch_dataset[old * 3 + 2];
+        for (int k = 0; k < n; ++k) {
+          const float x2 = batch_dataset[k * 3 + 0];
+          const float y2 = batch_dataset[k * 3 + 1];
+          const float z2 = batch_dataset[k * 3 + 2];
+          const float mag = (x2 * x2) + (y2 * y2) + (z2 * z2);
+          if (mag <= 1e-3) continue;
+
+          const float d = (x2 - x1) * (x2 - x1) + (y2 - y1) * (y2 - y1) +
+                          (z2 - z1) * (z2 - z1);
+          const float d2 = std::min(d, batch_temp[k]);
+          batch_temp[k] = d2;
+          if (d2 > best) {
+            best = d2;
+            besti = k;
+          }
+        }
+        old = besti;
+        batch_idxs[j] = old;
+      }
+    }
+  });
+}
@@ -0,0 +1,104 @@
+r"""
+Pure PyTorch implementations of the ``pointnet2_ops._ext`` entry points.
+
+Every function mirrors the signature, dtypes and semantics of its C++/CUDA
+counterpart (int32 indices, float32 features), so ``pointnet2_utils`` can use
+this module as a drop-in backend on hosts where the compiled extension is not
+available. All operations are vectorized over the batch; only furthest point
+sampling keeps a (batched) loop over the number of samples.
+"""
+import torch
+
+
+def _square_distance(src, dst):
+    # (B, n, 3), (B, m, 3) -> (B, n, m), clamped against round-off below zero
+    dist = -2 * torch.matmul(src, dst.transpose(1, 2))
+    dist += torch.sum(src ** 2, -1).unsqueeze(-1)
+    dist += torch.sum(dst ** 2, -1).unsqueeze(-2)
+    return dist.clamp_min_(0)
+
+
+def _expand_idx(idx, c):
+    # (B, ...) -> (B, c, prod(...)) long tensor usable with gather / scatter_add
+    return idx.reshape(idx.size(0), 1, -1).long().expand(-1, c, -1)
+
+
+def furthest_point_sampling(points, nsamples):
+    # type: (torch.Tensor, int) -> torch.Tensor
+    B, N, _ = points.shape
+    output = torch.zeros(B, nsamples, dtype=torch.int32, device=points.device)
+    if nsamples <= 0:
+        return output
+    # same conventions as the CUDA kernel: start at index 0 and never pick points at the origin
+    valid = torch.sum(points ** 2, -1) > 1e-3
+    temp = torch.full((B, N), 1e10, dtype=points.dtype, device=points.device)
+    batch_indices = torch.arange(B, device=points.device)
+    farthest = torch.zeros(B, dtype=torch.long, device=points.device)
+    for j in range(1, nsamples):
+        centroid = points[batch_indices, farthest].unsqueeze(1)
+        temp = torch.min(temp, torch.sum((points - centroid) ** 2, -1))
+        farthest = torch.where(valid, temp, temp.new_tensor(-1.)).max(-1)[1]
+        output[:, j] = farthest
+    return output
+
+
+def gather_points(points, idx):
+    # (B, C, N), (B, npoint) -> (B, C, npoint)
+    return torch.gather(points, 2, _expand_idx(idx, points.size(1)))
+
+
+def gather_points_grad(grad_out, idx, n):
+    B, C, _ = grad_out.shape
+    grad_points = grad_out.new_zeros(B, C, n)
+    return grad_points.scatter_add_(2, _expand_idx(idx, C), grad_out)
+
+
+def three_nn(unknowns, knows):
+    # (B, n, 3), (B, m, 3) -> [(B, n, 3) squared distances, (B, n, 3) indices]
+    k = min(3, knows.size(1))
+    dist2, idx = torch.topk(_square_distance(unknowns, knows), k, dim=-1, largest=False, sorted=True)
+    if k < 3:
+        # like the kernels with fewer than 3 known points: index 0 at the float32 infinity of their 1e40
+        dist2 = torch.cat([dist2, dist2.new_full(dist2.shape[:2] + (3 - k,), float('inf'))], dim=-1)
+        idx = torch.cat([idx, idx.new_zeros(idx.shape[:2] + (3 - k,))], dim=-1)
+    return [dist2, idx.int()]
+
+
+def three_interpolate(points, idx, weight):
+    # (B, C, m), (B, n, 3), (B, n, 3) -> (B, C, n)
+    B, C, _ = points.shape
+    n = idx.size(1)
+    neighbours = torch.gather(points, 2, _expand_idx(idx, C)).view(B, C, n, 3)
+    return torch.sum(neighbours * weight.unsqueeze(1), dim=-1)
+
+
+def three_interpolate_grad(grad_out, idx, weight, m):
+    B, C, n = grad_out.shape
+    contrib = (grad_out.unsqueeze(-1) * weight.unsqueeze(1)).reshape(B, C, n * 3)
+    grad_points = grad_out.new_zeros(B, C, m)
+    return grad_points.scatter_add_(2, _expand_idx(idx, C), contrib)
+
+
+def ball_query(new_xyz, xyz, radius, nsample):
+    # (B, npoint, 3), (B, N, 3) -> (B, npoint, nsample): the first nsample points (in index order)
+    # inside the ball, padded with the first hit; all zeros when the ball is empty
+    N = xyz.size(1)
+    group_idx = torch.arange(N, device=xyz.device).view(1, 1, N).expand(new_xyz.size(0), new_xyz.size(1), N)
+    group_idx = torch.where(_square_distance(new_xyz, xyz) < radius ** 2, group_idx, torch.full_like(group_idx, N))
+    group_idx = group_idx.sort(dim=-1)[0][:, :, :nsample]
+    group_first = group_idx[:, :, :1]
+    group_first = torch.where(group_first == N, torch.zeros_like(group_first), group_first)
+    group_idx = torch.where(group_idx == N, group_first.expand_as(group_idx), group_idx)
+    return group_idx.int()
+
+
+def group_points(points, idx):
+    # (B, C, N), (B, npoint, nsample) -> (B, C, npoint, nsample)
+    B, C, _ = points.shape
+    return torch.gather(points, 2, _expand_idx(idx, C)).view(B, C, idx.size(1), idx.size(2))
+
+
+def group_points_grad(grad_out, idx, n):
+    B, C, _, _ = grad_out.shape
+    grad_points = grad_out.new_zeros(B, C, n)
+    return grad_points.scatter_add_(2, _expand_idx(idx, C), grad_out.reshape(B, C, -1))
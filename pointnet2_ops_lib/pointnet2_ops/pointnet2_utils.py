@@ -1,35 +1,78 @@
+import os
 import torch
 import torch.nn as nn
 import warnings
 from torch.autograd import Function
 from typing import *
 
-try:
-    import pointnet2_ops._ext as _ext
-except ImportError:
-    from torch.utils.cpp_extension import load
-    import glob
-    import os.path as osp
-    import os
-
-    warnings.warn("Unable to load pointnet2_ops cpp extension. JIT Compiling.")
-
-    _ext_src_root = osp.join(osp.dirname(__file__), "_ext-src")
-    _ext_sources = glob.glob(osp.join(_ext_src_root, "src", "*.cpp")) + glob.glob(
-        osp.join(_ext_src_root, "src", "*.cu")
-    )
-    _ext_headers = glob.glob(osp.join(_ext_src_root, "include", "*"))
-
-    os.environ["TORCH_CUDA_ARCH_LIST"] = "3.7+PTX;5.0;6.0;6.1;6.2;7.0;7.5"
-    _ext = load(
-        "_ext",
-        sources=_ext_sources,
-        extra_include_paths=[osp.join(_ext_src_root, "include")],
-        extra_cflags=["-O3"],
-        extra_cuda_cflags=["-O3", "-Xfatbin", "-compress-all"],
-        with_cuda=True,
+from pointnet2_ops import _torch_ops
+
+# Backend selection, done once at import time:
+#   POINTNET2_OPS_BACKEND=auto   (default) compiled extension if installed, pure torch otherwise
+#   POINTNET2_OPS_BACKEND=ext    require the compiled extension
+#   POINTNET2_OPS_BACKEND=torch  always use the pure torch implementations
+#   POINTNET2_OPS_BACKEND=jit    JIT compile the extension if it is not installed (slow cold start)
+BACKEND = os.environ.get("POINTNET2_OPS_BACKEND", "auto").lower()
+if BACKEND not in ["auto", "ext", "torch", "jit"]:
+    raise ValueError(
+        "Unrecognized POINTNET2_OPS_BACKEND=%s. Should be one of [auto, ext, torch, jit]." % BACKEND
     )
 
+_ext = None
+if BACKEND != "torch":
+    try:
+        import pointnet2_ops._ext as _ext
+    except ImportError:
+        if BACKEND == "ext":
+            raise
+        if BACKEND == "jit":
+            from torch.utils.cpp_extension import load
+            import glob
+            import os.path as osp
+            import sys
+
+            warnings.warn("Unable to load pointnet2_ops cpp extension. JIT Compiling.")
+
+            _ext_src_root = osp.join(osp.dirname(__file__), "_ext-src")
+            _ext_sources = glob.glob(osp.join(_ext_src_root, "src", "*.cpp"))
+            _ext_headers = glob.glob(osp.join(_ext_src_root, "include", "*"))
+
+            _with_cuda = torch.cuda.is_available()
+            _ext_cflags = ["-O3", "-fopenmp"] if sys.platform.startswith("linux") else ["-O3"]
+            if _with_cuda:
+                _ext_sources += glob.glob(osp.join(_ext_src_root, "src", "*.cu"))
+                _ext_cflags.append("-DWITH_CUDA")
+                os.environ["TORCH_CUDA_ARCH_LIST"] = "3.7+PTX;5.0;6.0;6.1;6.2;7.0;7.5"
+            _ext = load(
+                "_ext",
+                sources=_ext_sources,
+                extra_include_paths=[osp.join(_ext_src_root, "include")],
+                extra_cflags=_ext_cflags,
+                extra_cuda_cflags=["-O3", "-Xfatbin", "-compress-all"],
+                with_cuda=_with_cuda,
+            )
+        else:
+            warnings.warn(
+                "Unable to load pointnet2_ops cpp extension, falling back to the pure torch implementation. "
+                "Set POINTNET2_OPS_BACKEND=jit to compile it instead."
+            )
+
+# device type -> module implementing the _ext entry points
+_BACKENDS = {"cpu": _torch_ops, "cuda": _torch_ops}
+if _ext is not None:
+    _BACKENDS["cpu"] = _ext
+    # builds that predate with_cuda() were always compiled with CUDA
+    if getattr(_ext, "with_cuda", lambda: True)():
+        _BACKENDS["cuda"] = _ext
+
+
+def get_backend(device):
+    # type: (torch.device) -> Any
+    r"""
+    Returns the module (compiled extension or ``_torch_ops``) that serves tensors on ``device``
+    """
+    return _BACKENDS.get(torch.device(device).type, _torch_ops)
+
 
 class FurthestPointSampling(Function):
     @staticmethod
@@ -51,7 +94,7 @@ class FurthestPointSampling(Function):
         torch.Tensor
             (B, npoint) tensor containing the set
         """
-        out = _ext.furthest_point_sampling(xyz, npoint)
+        out = get_backend(xyz.device).furthest_point_sampling(xyz, npoint)
 
         ctx.mark_non_differentiable(out)
 
@@ -87,14 +130,14 @@ class GatherOperation(Function):
 
         ctx.save_for_backward(idx, features)
 
-        return _ext.gather_points(features, idx)
+        return get_backend(features.device).gather_points(features, idx)
 
     @staticmethod
     def backward(ctx, grad_out):
         idx, features = ctx.saved_tensors
         N = features.size(2)
 
-        grad_features = _ext.gather_points_grad(grad_out.contiguous(), idx, N)
+        grad_features = get_backend(grad_out.device).gather_points_grad(grad_out.contiguous(), idx, N)
         return grad_features, None
 
 
@@ -121,7 +164,7 @@ class ThreeNN(Function):
         idx : torch.Tensor
             (B, n, 3) index of 3 nearest neighbors
         """
-        dist2, idx = _ext.three_nn(unknown, known)
+        dist2, idx = get_backend(unknown.device).three_nn(unknown, known)
         dist = torch.sqrt(dist2)
 
         ctx.mark_non_differentiable(dist, idx)
@@ -158,7 +201,7 @@ class ThreeInterpolate(Function):
         """
         ctx.save_for_backward(idx, weight, features)
 
-        return _ext.three_interpolate(features, idx, weight)
+        return get_backend(features.device).three_interpolate(features, idx, weight)
 
     @staticmethod
     def backward(ctx, grad_out):
@@ -181,7 +224,7 @@ class ThreeInterpolate(Function):
         idx, weight, features = ctx.saved_tensors
         m = features.size(2)
 
-        grad_features = _ext.three_interpolate_grad(
+        grad_features = get_backend(grad_out.device).three_interpolate_grad(
             grad_out.contiguous(), idx, weight, m
         )
 
@@ -211,7 +254,7 @@ class GroupingOperation(Function):
         """
         ctx.save_for_backward(idx, features)
 
-        return _ext.group_points(features, idx)
+        return get_backend(features.device).group_points(features, idx)
 
     @staticmethod
     def backward(ctx, grad_out):
@@ -232,7 +275,7 @@ class GroupingOperation(Function):
         idx, features = ctx.saved_tensors
         N = features.size(2)
 
-        grad_features = _ext.group_points_grad(grad_out.contiguous(), idx, N)
+        grad_features = get_backend(grad_out.device).group_points_grad(grad_out.contiguous(), idx, N)
 
         return grad_features, torch.zeros_like(idx)
 
@@ -262,7 +305,7 @@ class BallQuery(Function):
         torch.Tensor
             (B, npoint, nsample) tensor with the indicies of the features that form the query balls
         """
-        output = _ext.ball_query(new_xyz, xyz, radius, nsample)
+        output = get_backend(new_xyz.device).ball_query(new_xyz, xyz, radius, nsample)
 
         ctx.mark_non_differentiable(output)
 
@@ -1,39 +1,53 @@
 import glob
 import os
 import os.path as osp
+import sys
 
 from setuptools import find_packages, setup
-from torch.utils.cpp_extension import BuildExtension, CUDAExtension
+import torch
+from torch.utils.cpp_extension import CUDA_HOME, BuildExtension, CppExtension, CUDAExtension
 
 this_dir = osp.dirname(osp.abspath(__file__))
 _ext_src_root = osp.join("pointnet2_ops", "_ext-src")
-_ext_sources = glob.glob(osp.join(_ext_src_root, "src", "*.cpp")) + glob.glob(
-    osp.join(_ext_src_root, "src", "*.cu")
-)
+_ext_sources = glob.glob(osp.join(_ext_src_root, "src", "*.cpp"))
 _ext_headers = glob.glob(osp.join(_ext_src_root, "include", "*"))
 
 requirements = ["torch>=1.4"]
 
 exec(open(osp.join("pointnet2_ops", "_version.py")).read())
 
-os.environ["TORCH_CUDA_ARCH_LIST"] = "3.7+PTX;5.0;6.0;6.1;6.2;7.0;7.5"
+# at::parallel_for only spreads the CPU kernels over threads when compiled with OpenMP.
+_cxx_flags = ["-O3", "-fopenmp"] if sys.platform.startswith("linux") else ["-O3"]
+
+# The CPU kernels are always built; the CUDA kernels are added when a CUDA toolchain is
+# present (or FORCE_CUDA=1, e.g. when building GPU wheels on a GPU-less machine).
+with_cuda = CUDA_HOME is not None and (torch.cuda.is_available() or os.getenv("FORCE_CUDA", "0") == "1")
+if with_cuda:
+    os.environ["TORCH_CUDA_ARCH_LIST"] = "3.7+PTX;5.0;6.0;6.1;6.2;7.0;7.5"
+    ext_module = CUDAExtension(
+        name="pointnet2_ops._ext",
+        sources=_ext_sources + glob.glob(osp.join(_ext_src_root, "src", "*.cu")),
+        extra_compile_args={
+            "cxx": _cxx_flags + ["-DWITH_CUDA"],
+            "nvcc": ["-O3", "-Xfatbin", "-compress-all"],
+        },
+        include_dirs=[osp.join(this_dir, _ext_src_root, "include")],
+    )
+else:
+    ext_module = CppExtension(
+        name="pointnet2_ops._ext",
+        sources=_ext_sources,
+        extra_compile_args={"cxx": _cxx_flags},
+        include_dirs=[osp.join(this_dir, _ext_src_root, "include")],
+    )
+
 setup(
     name="pointnet2_ops",
     version=__version__,
     author="Erik Wijmans",
     packages=find_packages(),
     install_requires=requirements,
-    ext_modules=[
-        CUDAExtension(
-            name="pointnet2_ops._ext",
-            sources=_ext_sources,
-            extra_compile_args={
-                "cxx": ["-O3"],
-                "nvcc": ["-O3", "-Xfatbin", "-compress-all"],
-            },
-            include_dirs=[osp.join(this_dir, _ext_src_root, "include")],
-        )
-    ],
+    ext_modules=[ext_module],
     cmdclass={"build_ext": BuildExtension},
     include_package_data=True,
 )
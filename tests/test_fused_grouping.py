@@ -0,0 +1,61 @@
+import importlib
+import itertools
+import pytest
+import torch
+
+# the classification and part segmentation folders each carry a copy of FusedGrouping and LocalGrouper
+MODELS = ["classification_ModelNet40.models.pointmlp", "classification_ScanObjectNN.models.pointmlp",
+          "part_segmentation.model.pointMLP"]
+VARIANTS = list(itertools.product(["center", "anchor"], [True, False], [True, False]))  # normalize, use_xyz, concat
+
+
+def random_groups(B=2, N=16, d=4, S=5, K=4, dtype=torch.float64):
+    torch.manual_seed(0)
+    xyz = torch.rand(B, N, 3, dtype=dtype, requires_grad=True)
+    points = torch.randn(B, N, d, dtype=dtype, requires_grad=True)
+    fps_idx = torch.stack([torch.randperm(N)[:S] for _ in range(B)])
+    idx = torch.randint(0, N, (B, S, K))
+    return xyz, points, fps_idx, idx
+
+
+@pytest.mark.parametrize("module", MODELS)
+@pytest.mark.parametrize("normalize,use_xyz,concat", VARIANTS)
+def test_fused_grouping_gradcheck(module, normalize, use_xyz, concat):
+    pointmlp = importlib.import_module(module)
+    xyz, points, fps_idx, idx = random_groups()
+    channels = points.shape[-1] + (3 if use_xyz else 0)
+    alpha = (1 + torch.rand(1, 1, 1, channels, dtype=torch.float64)).requires_grad_()
+    beta = torch.randn(1, 1, 1, channels, dtype=torch.float64, requires_grad=True)
+
+    def fused(xyz, points, alpha, beta):
+        return pointmlp.FusedGrouping.apply(xyz, points, fps_idx, idx, alpha, beta, normalize, use_xyz, concat)
+    assert torch.autograd.gradcheck(fused, (xyz, points, alpha, beta))
+
+
+@pytest.mark.parametrize("module", MODELS)
+@pytest.mark.parametrize("normalize,use_xyz,concat_anchor", VARIANTS)
+def test_fused_matches_unfused_local_grouper(module, normalize, use_xyz, concat_anchor):
+    pointmlp = importlib.import_module(module)
+    xyz, points, _, _ = random_groups(N=64, d=8, dtype=torch.float32)
+    outputs, grads = [], []
+    for fused in [True, False]:
+        torch.manual_seed(1)
+        grouper = pointmlp.LocalGrouper(8, 16, 8, use_xyz=use_xyz, normalize=normalize, fused=fused,
+                                        concat_anchor=concat_anchor)
+        with torch.no_grad():
+            grouper.affine_alpha.uniform_(0.5, 1.5)
+            grouper.affine_beta.normal_()
+        new_xyz, new_points = grouper(xyz, points)
+        out = [new_xyz] + (list(new_points) if isinstance(new_points, tuple) else [new_points])
+        # a fixed random projection, so every output element gets its own gradient
+        torch.manual_seed(2)
+        loss = sum((o * torch.randn_like(o)).sum() for o in out)
+        params = [xyz, points, grouper.affine_alpha, grouper.affine_beta]
+        outputs.append(out)
+        grads.append(torch.autograd.grad(loss, params, allow_unused=True))
+    for fused_out, plain_out in zip(*outputs):
+        torch.testing.assert_close(fused_out, plain_out, rtol=1e-5, atol=1e-5)
+    for fused_grad, plain_grad in zip(*grads):
+        fused_grad = torch.zeros_like(plain_grad) if fused_grad is None else fused_grad
+        plain_grad = torch.zeros_like(fused_grad) if plain_grad is None else plain_grad
+        torch.testing.assert_close(fused_grad, plain_grad, rtol=1e-4, atol=1e-4)
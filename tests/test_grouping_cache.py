@@ -0,0 +1,43 @@
+import importlib
+import pytest
+import torch
+
+# the classification folders each carry a copy of the model
+MODELS = ["classification_ModelNet40.models.pointmlp", "classification_ScanObjectNN.models.pointmlp"]
+
+
+def make_grouper(module):
+    pointmlp = importlib.import_module(module)
+    grouper = pointmlp.LocalGrouper(8, groups=32, kneighbors=8, use_xyz=False, normalize="anchor",
+                                    cache=pointmlp.GroupingCache())
+    return grouper.eval()
+
+
+@pytest.mark.parametrize("module", MODELS)
+def test_cached_grouping_matches_grouping_over_permuted_batches(module):
+    torch.manual_seed(0)
+    grouper = make_grouper(module)
+    clouds = torch.rand(6, 128, 3)
+    expected_fps, expected_idx = grouper.grouping(clouds)
+    # a cloud is admitted on its second sighting, the third pass is served from the cache
+    for _ in range(3):
+        perm = torch.randperm(len(clouds))
+        fps_idx, idx = grouper.cached_grouping(clouds[perm])
+        assert torch.equal(fps_idx, expected_fps[perm])
+        assert torch.equal(idx, expected_idx[perm])
+    assert grouper.cache.hits == len(clouds)
+
+
+@pytest.mark.skipif(torch.cuda.device_count() < 2, reason="needs two GPUs")
+@pytest.mark.parametrize("module", MODELS)
+def test_cached_grouping_across_devices(module):
+    # nn.DataParallel replicas share the cache, entries stored on one device are served to another
+    torch.manual_seed(0)
+    grouper = make_grouper(module)
+    clouds = torch.rand(4, 128, 3)
+    expected_fps, expected_idx = grouper.grouping(clouds.cuda(0))
+    for device in ["cuda:0", "cuda:1", "cuda:1", "cuda:0"]:
+        fps_idx, idx = grouper.cached_grouping(clouds.to(device))
+        assert fps_idx.device == idx.device == torch.device(device)
+        assert torch.equal(fps_idx.cpu(), expected_fps.cpu())
+        assert torch.equal(idx.cpu(), expected_idx.cpu())